@@ -3,26 +3,114 @@
 Simplified Particle Animation Script for Vercel Deployment
 This is a lightweight version that demonstrates the interface functionality
 without heavy AI dependencies that may not work in serverless environments.
+
+When the full engine's dependencies are installed, render_animation() runs the
+real style engine from style_engine.py instead. Both renderers are plain
+functions so long-lived render workers can import them once and reuse them.
 """
 
 import os
 import sys
 import time
 import shutil
+import importlib.util
 from PIL import Image, ImageDraw, ImageFilter
 import tempfile
 
-def create_demo_animation():
+PAINTING_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+FPS = 30
+
+# Web quality names -> (max image size, bitrate, CRF, depth size). Ultra estimates depth
+# above DEPTH_TILE_THRESHOLD (default 1600), so large uploads get tiled depth
+QUALITY_PRESETS = {
+    'standard': (800, '8000k', '20', 800),
+    'high': (1000, '15000k', '18', 1000),
+    'ultra': (1200, '25000k', '15', 2400),
+}
+# Previews run the same style code on a small canvas at a lower frame rate
+PREVIEW_SIZE = 320
+PREVIEW_FPS = 12
+PREVIEW_ENCODING = ('1500k', '28')
+DEPTH_BACKENDS = ('torch', 'onnx')
+# Longest animation the web app accepts, in seconds
+MAX_DURATION = 30
+ENGINE_STYLES = ('ethereal', 'cyberpunk', 'impressionist', 'abstract', 'dreamlike', 'particle_powder')
+
+# The engine's modules live one directory up; painting_io needs only Pillow, so the demo uses it too
+if PAINTING_DIR not in sys.path:
+    sys.path.insert(0, PAINTING_DIR)
+from painting_io import open_painting, oriented_size
+
+def full_engine_available(depth_backend=None):
+    """True when the heavy dependencies of the real style engine are installed"""
+    depth_backend = depth_backend or os.environ.get('DEPTH_BACKEND', 'torch')
+    runtime = 'onnxruntime' if depth_backend == 'onnx' else 'torch'
+    return all(importlib.util.find_spec(name) is not None for name in ('numpy', 'cv2', runtime))
+
+def load_engine():
+    """Import the style engine module; Python caches it for the life of the process"""
+    import style_engine
+    return style_engine
+
+def warm_up():
+    """Pre-import the engine and load the depth model, so the first job doesn't pay for it"""
+    if default_engine() != 'full':
+        return False
+    from depth_service import get_depth_model
+    get_depth_model()
+    load_engine()
+    return True
+
+def create_full_animation(input_path, output_path, duration=10, quality='ultra', style='particle_powder',
+                          progress=None, preview=False, depth_backend=None):
+    """Render the painting with the real style engine"""
+    if style not in ENGINE_STYLES:
+        raise ValueError(f"Unknown style: {style}")
+    max_size, bitrate, crf, depth_size = QUALITY_PRESETS.get(quality, QUALITY_PRESETS['ultra'])
+    engine = load_engine()
+    if preview:
+        # Depth is still estimated at the full quality's size: the preview fills the
+        # depth cache for the full render, and reuses it when that came first
+        print(f"👀 Previewing {style} at {PREVIEW_SIZE}px, {PREVIEW_FPS}fps for {duration}s...")
+        bitrate, crf = PREVIEW_ENCODING
+        return engine.render(input_path, output_path, style=style, num_frames=int(duration * PREVIEW_FPS),
+                             bitrate=bitrate, crf=crf, max_size=PREVIEW_SIZE, progress=progress,
+                             fps=PREVIEW_FPS, preset='veryfast', depth_size=depth_size, depth_backend=depth_backend)
+    print(f"🎨 Rendering {style} ({quality}) for {duration}s...")
+    return engine.render(input_path, output_path, style=style, num_frames=int(duration * FPS),
+                         bitrate=bitrate, crf=crf, max_size=max_size, progress=progress, depth_size=depth_size,
+                         depth_backend=depth_backend)
+
+def source_info(input_path):
+    """Upright size and format of an uploaded image, read from its header without decoding pixels"""
+    with Image.open(input_path) as img:
+        width, height = oriented_size(img)
+        return {'width': width, 'height': height, 'format': img.format}
+
+def default_engine(depth_backend=None):
+    return os.environ.get('ANIMATION_ENGINE') or ('full' if full_engine_available(depth_backend) else 'demo')
+
+def render_animation(input_path, output_path, duration=10, quality='ultra', style='particle_powder', engine=None,
+                     progress=None, preview=False, depth_backend=None):
+    """Render with the full engine when available, otherwise the demo placeholder.
+
+    progress, if given, is called with a dict such as {'stage': 'frames', 'current': 12, 'total': 300}.
+    preview renders a small, low frame rate version of the same animation.
+    depth_backend ('torch' or 'onnx') overrides DEPTH_BACKEND for the full engine.
+    """
+    engine = engine or default_engine()
+    if engine == 'full':
+        create_full_animation(input_path, output_path, duration, quality, style, progress=progress, preview=preview,
+                              depth_backend=depth_backend)
+        return True
+    return create_demo_animation(input_path, output_path, duration, quality, style, progress=progress,
+                                 preview=preview)
+
+def create_demo_animation(input_path, output_path, duration=10, quality='ultra', style='particle_powder',
+                          progress=None, preview=False):
     """Create a simple demo animation video"""
     print("🎨 Creating demo particle animation...")
     
-    # Get parameters from environment variables
-    input_path = os.environ.get('ANIMATION_INPUT_PATH')
-    output_path = os.environ.get('ANIMATION_OUTPUT_PATH')
-    duration = int(os.environ.get('ANIMATION_DURATION', '10'))
-    quality = os.environ.get('ANIMATION_QUALITY', 'ultra')
-    style = os.environ.get('ANIMATION_STYLE', 'particle_powder')
-    
     if not input_path or not output_path:
         print("❌ Missing input or output path")
         return False
@@ -38,19 +126,10 @@ def create_demo_animation():
     print(f"🎨 Style: {style}")
     
     try:
-        # Load the input image
-        with Image.open(input_path) as img:
-            # Convert to RGB if needed
-            if img.mode != 'RGB':
-                img = img.convert('RGB')
-            
-            # Resize for processing
-            max_size = 800
-            if max(img.size) > max_size:
-                ratio = max_size / max(img.size)
-                new_size = (int(img.size[0] * ratio), int(img.size[1] * ratio))
-                img = img.resize(new_size, Image.Resampling.LANCZOS)
-            
+        # Load the input image, decoded close to the processing size
+        max_size = PREVIEW_SIZE if preview else 800
+        with open_painting(input_path, max_size)[0] as img:
+            img.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
             print(f"🖼️ Image size: {img.size}")
             
             # For now, create a simple demo by copying the input image to output
@@ -61,9 +140,12 @@ def create_demo_animation():
             
             # Simulate processing time
             print("🔄 Processing particle animation...")
-            for i in range(5):
-                print(f"⏳ Processing frame batch {i+1}/5...")
+            batches = 1 if preview else 5
+            for i in range(batches):
+                print(f"⏳ Processing frame batch {i+1}/{batches}...")
                 time.sleep(1)  # Simulate processing
+                if progress is not None:
+                    progress({'stage': 'frames', 'current': i + 1, 'total': batches})
             
             # Create a simple "video" file (placeholder)
             # In a real implementation, this would generate actual MP4
@@ -75,6 +157,7 @@ def create_demo_animation():
                 Duration: {duration} seconds
                 Quality: {quality}
                 Style: {style}
+                Preview: {preview}
                 Size: {img.size}
                 
                 This is a demo placeholder for Vercel deployment.
@@ -103,7 +186,19 @@ def main():
     print("🚀 Makart Particle Animation Engine - Demo Mode")
     print("=" * 50)
     
-    success = create_demo_animation()
+    # Get parameters from environment variables
+    input_path = os.environ.get('ANIMATION_INPUT_PATH')
+    output_path = os.environ.get('ANIMATION_OUTPUT_PATH')
+    duration = int(os.environ.get('ANIMATION_DURATION', '10'))
+    quality = os.environ.get('ANIMATION_QUALITY', 'ultra')
+    style = os.environ.get('ANIMATION_STYLE', 'particle_powder')
+    preview = os.environ.get('ANIMATION_PREVIEW', '').lower() in ('1', 'true', 'yes')
+    
+    try:
+        success = render_animation(input_path, output_path, duration, quality, style, preview=preview)
+    except Exception as e:
+        print(f"❌ Error rendering animation: {e}")
+        success = False
     
     if success:
         print("🎉 Animation processing completed!")
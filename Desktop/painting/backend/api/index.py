@@ -1,13 +1,16 @@
-from flask import Flask, request, jsonify, send_file, session
+from flask import Flask, Response, request, jsonify, send_file, session
 from flask_cors import CORS
 import os
-import subprocess
-import tempfile
-import uuid
-import shutil
-from werkzeug.utils import secure_filename
+import multiprocessing
 from functools import wraps
 import logging
+import shutil
+from PIL import UnidentifiedImageError
+
+from jobs import get_render_queue, job_events, job_status, DONE
+from animate_painting_premium import (default_engine, source_info, DEPTH_BACKENDS, ENGINE_STYLES, MAX_DURATION,
+                                      QUALITY_PRESETS)
+from uploads import receive_upload, UploadError
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -20,8 +23,8 @@ app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024  # 50MB max file size
 # Configure CORS to be more robust
 CORS(app, 
      origins=["https://makart.vercel.app", "http://localhost:3000"], 
-     methods=["GET", "POST", "OPTIONS"], 
-     headers=["Content-Type"], 
+     methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"], 
+     allow_headers=["Content-Type", "X-Chunk-Sha256"], 
      supports_credentials=True)
 
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp', 'tiff', 'webp'}
@@ -87,79 +90,212 @@ def check_session():
         logger.error(f"Session check error: {str(e)}")
         return jsonify({'logged_in': False}), 200
 
+def render_options(form):
+    """Render parameters from upload form fields or JSON; raises ValueError on bad input"""
+    depth_backend = form.get('depth_backend') or os.environ.get('DEPTH_BACKEND', 'torch')
+    if depth_backend not in DEPTH_BACKENDS:
+        raise ValueError(f"Unknown depth backend: {depth_backend}")
+    try:
+        duration = int(form.get('duration', 10))
+    except (TypeError, ValueError):
+        raise ValueError('duration must be a whole number of seconds')
+    if not 1 <= duration <= MAX_DURATION:
+        raise ValueError(f"duration must be between 1 and {MAX_DURATION} seconds")
+    quality = str(form.get('quality', 'ultra'))
+    if quality not in QUALITY_PRESETS:
+        raise ValueError(f"Unknown quality: {quality}")
+    style = str(form.get('style', 'particle_powder'))
+    if style not in ENGINE_STYLES:
+        raise ValueError(f"Unknown style: {style}")
+    return {
+        'duration': duration,
+        'quality': quality,
+        'style': style,
+        'preview': str(form.get('preview', '')).lower() in ('1', 'true', 'yes', 'on'),
+        'depth_backend': depth_backend,
+    }
+
+def submit_upload(queue, job_id, work_dir, upload, options):
+    """Queue a render of a received upload and build the 202 response"""
+    try:
+        image = source_info(upload.path)
+    except (UnidentifiedImageError, OSError):
+        shutil.rmtree(work_dir, ignore_errors=True)
+        return jsonify({'error': 'File is not a readable image'}), 400
+    
+    logger.info(f"Processing upload: {upload.filename} ({upload.size} bytes), duration: {options['duration']}, "
+                f"preview: {options['preview']}")
+    
+    params = {**options, 'filename': upload.filename, 'engine': default_engine(options['depth_backend']),
+              'image': image}
+    job, source = queue.submit(job_id, work_dir, upload.path, params, owner=session.get('user_email'),
+                               image_sha256=upload.sha256)
+    
+    if source == 'cache':
+        logger.info(f"Served job {job['id']} from the result cache")
+        message = 'This animation was already rendered - it is ready to download!'
+    elif source == 'attached':
+        logger.info(f"Upload matches in-flight job {job['id']}")
+        message = 'This animation is already being rendered.'
+    else:
+        logger.info(f"Queued render job {job['id']}")
+        message = 'Upload received successfully! Your animation has been queued.'
+    
+    return jsonify({'message': message, 'source': source, **job_status(queue.store, job)}), 202  # 202 Accepted
+
 @app.route('/api/upload', methods=['POST'])
 @login_required
 def upload_file():
     try:
-        if 'file' not in request.files:
-            return jsonify({'error': 'No file uploaded'}), 400
+        queue = get_render_queue()
+        job_id, work_dir = queue.new_job_dir()
+        # The body streams straight into the job directory; request.files would buffer it first
+        try:
+            upload = receive_upload(request, work_dir, app.config['MAX_CONTENT_LENGTH'], allowed_file=allowed_file)
+            options = render_options(upload.fields)
+        except (UploadError, ValueError) as e:
+            shutil.rmtree(work_dir, ignore_errors=True)
+            return jsonify({'error': str(e)}), getattr(e, 'status', 400)
         
-        file = request.files['file']
-        if file.filename == '' or not allowed_file(file.filename):
+        return submit_upload(queue, job_id, work_dir, upload, options)
+            
+    except Exception as e:
+        logger.error(f"Upload error: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/uploads', methods=['POST'])
+@login_required
+def start_chunked_upload():
+    """Begin a resumable upload: JSON with filename, size, optional chunk_size and sha256, and render options"""
+    try:
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return jsonify({'error': 'Expected a JSON object'}), 400
+        filename = data.get('filename')
+        size = data.get('size')
+        if not isinstance(filename, str) or not allowed_file(filename):
             return jsonify({'error': 'Invalid file'}), 400
-        
-        duration = int(request.form.get('duration', 10))
-        quality = request.form.get('quality', 'ultra')
-        style = request.form.get('style', 'particle_powder')
-        
-        logger.info(f"Processing upload: {file.filename}, duration: {duration}")
-        
-        # For now, return a demo response since we're in lightweight mode
-        # This allows login/auth to work while animation dependencies are being resolved
-        return jsonify({
-            'message': 'Upload received successfully! Animation processing is being prepared.',
-            'filename': file.filename,
-            'duration': duration,
-            'quality': quality,
-            'style': style,
-            'status': 'demo_mode'
-        }), 202  # 202 Accepted
-        
-        # TODO: Uncomment below when full dependencies are available
-        """
-        temp_dir = tempfile.mkdtemp()
-        
+        if not isinstance(size, int) or isinstance(size, bool) or size <= 0:
+            return jsonify({'error': 'size must be a positive number of bytes'}), 400
+        if size > app.config['MAX_CONTENT_LENGTH']:
+            return jsonify({'error': 'File is too large'}), 413
         try:
-            input_path = os.path.join(temp_dir, secure_filename(file.filename))
-            file.save(input_path)
-            
-            output_path = os.path.join(temp_dir, f"animation_{uuid.uuid4()}.mp4")
-            
-            # Check if animation script exists
-            script_path = os.path.join(os.path.dirname(__file__), '..', 'animate_painting_premium.py')
-            if not os.path.exists(script_path):
-                logger.error(f"Animation script not found at: {script_path}")
-                return jsonify({'error': 'Animation service unavailable'}), 500
-            
-            env = {**os.environ, 
-                   'ANIMATION_INPUT_PATH': input_path, 
-                   'ANIMATION_OUTPUT_PATH': output_path,
-                   'ANIMATION_DURATION': str(duration),
-                   'ANIMATION_QUALITY': quality,
-                   'ANIMATION_STYLE': style}
-            
-            logger.info("Starting animation process")
-            result = subprocess.run(['python3', script_path], env=env, check=True, timeout=300, 
-                                  capture_output=True, text=True)
-            
-            if not os.path.exists(output_path):
-                logger.error("Animation file was not generated")
-                return jsonify({'error': 'Animation generation failed'}), 500
+            options = render_options(data)
+            manifest = get_render_queue().uploads.create(session.get('user_email'), filename, size, options,
+                                                         chunk_size=data.get('chunk_size'), sha256=data.get('sha256'))
+        except (UploadError, ValueError, TypeError) as e:
+            return jsonify({'error': str(e)}), getattr(e, 'status', 400)
+        
+        logger.info(f"Started chunked upload {manifest['id']}: {filename}, {size} bytes in "
+                    f"{manifest['total_chunks']} chunk(s)")
+        return jsonify(chunked_upload_status(manifest)), 201
+    except Exception as e:
+        logger.error(f"Chunked upload error: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+def chunked_upload_status(manifest):
+    status = get_render_queue().uploads.status(manifest)
+    status['status_url'] = f"/api/uploads/{manifest['id']}"
+    status['chunk_url'] = f"/api/uploads/{manifest['id']}/chunks/{{index}}"
+    status['complete_url'] = f"/api/uploads/{manifest['id']}/complete"
+    return status
+
+def get_owned_upload(upload_id):
+    return get_render_queue().uploads.get(upload_id, owner=session.get('user_email'))
+
+@app.route('/api/uploads/<upload_id>', methods=['GET'])
+@login_required
+def get_chunked_upload(upload_id):
+    manifest = get_owned_upload(upload_id)
+    if manifest is None:
+        return jsonify({'error': 'Upload not found'}), 404
+    return jsonify(chunked_upload_status(manifest)), 200
 
-            logger.info("Animation completed successfully")
-            return send_file(output_path, as_attachment=True, download_name="animation.mp4", mimetype='video/mp4')
+@app.route('/api/uploads/<upload_id>', methods=['DELETE'])
+@login_required
+def cancel_chunked_upload(upload_id):
+    manifest = get_owned_upload(upload_id)
+    if manifest is None:
+        return jsonify({'error': 'Upload not found'}), 404
+    get_render_queue().uploads.discard(upload_id)
+    return jsonify({'message': 'Upload cancelled'}), 200
+
+@app.route('/api/uploads/<upload_id>/chunks/<int:index>', methods=['PUT'])
+@login_required
+def put_upload_chunk(upload_id, index):
+    """Store one chunk; the body is the raw bytes and X-Chunk-Sha256 their hex SHA-256"""
+    manifest = get_owned_upload(upload_id)
+    if manifest is None:
+        return jsonify({'error': 'Upload not found'}), 404
+    if request.content_length is not None and request.content_length > manifest['chunk_size']:
+        return jsonify({'error': f"Chunks are at most {manifest['chunk_size']} bytes"}), 413
+    uploads = get_render_queue().uploads
+    try:
+        uploads.write_chunk(manifest, index, request.stream.read(manifest['chunk_size'] + 1),
+                            request.headers.get('X-Chunk-Sha256'))
+    except UploadError as e:
+        return jsonify({'error': str(e)}), e.status
+    return jsonify({'index': index, 'received': len(uploads.received(manifest)),
+                    'total_chunks': manifest['total_chunks']}), 200
+
+@app.route('/api/uploads/<upload_id>/complete', methods=['POST'])
+@login_required
+def complete_chunked_upload(upload_id):
+    """Assemble a fully received upload into a render job"""
+    try:
+        manifest = get_owned_upload(upload_id)
+        if manifest is None:
+            return jsonify({'error': 'Upload not found'}), 404
+        queue = get_render_queue()
+        job_id, work_dir = queue.new_job_dir()
+        try:
+            upload = queue.uploads.complete(manifest, work_dir)
+        except UploadError as e:
+            shutil.rmtree(work_dir, ignore_errors=True)
+            if e.status == 409:
+                return jsonify({'error': str(e), **chunked_upload_status(manifest)}), 409
+            return jsonify({'error': str(e)}), e.status
         
-        finally:
-            shutil.rmtree(temp_dir)
-        """
-            
-    except subprocess.TimeoutExpired:
-        logger.error("Animation process timed out")
-        return jsonify({'error': 'Animation processing timed out'}), 500
+        return submit_upload(queue, job_id, work_dir, upload, upload.fields)
     except Exception as e:
-        logger.error(f"Upload error: {str(e)}")
+        logger.error(f"Chunked upload error: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+def get_owned_job(job_id):
+    queue = get_render_queue()
+    job = queue.store.get(job_id)
+    if job is None or job['owner'] != session.get('user_email'):
+        return queue, None
+    return queue, job
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+@login_required
+def get_job(job_id):
+    queue, job = get_owned_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job_status(queue.store, job)), 200
+
+@app.route('/api/jobs/<job_id>/events', methods=['GET'])
+@login_required
+def job_progress_events(job_id):
+    queue, job = get_owned_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return Response(job_events(queue.store, job_id), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/jobs/<job_id>/download', methods=['GET'])
+@login_required
+def download_job(job_id):
+    queue, job = get_owned_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    if job['status'] != DONE or not os.path.exists(job['output_path']):
+        return jsonify({'error': 'Animation is not ready yet', **job_status(queue.store, job)}), 409
+    download_name = "preview.mp4" if job['params'].get('preview') else "animation.mp4"
+    return send_file(job['output_path'], as_attachment=True, download_name=download_name, mimetype='video/mp4')
+
 @app.errorhandler(404)
 def not_found(error):
     return jsonify({'error': 'Endpoint not found'}), 404
@@ -168,6 +304,11 @@ def not_found(error):
 def internal_error(error):
     return jsonify({'error': 'Internal server error'}), 500
 
+# Start the render workers with the app so jobs queued before a restart resume.
+# Render worker processes re-import this module and must not start a queue of their own.
+if multiprocessing.parent_process() is None:
+    get_render_queue()
+
 if __name__ == '__main__':
     logger.info("Starting Makart backend server")
     app.run(debug=True, host='0.0.0.0', port=5001) 
\ No newline at end of file
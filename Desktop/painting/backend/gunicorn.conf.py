@@ -0,0 +1,21 @@
+"""
+Gunicorn settings for the Makart backend; loaded automatically from this directory.
+
+Requests are served by threads of a single worker process. /api/jobs/<id>/events
+holds a thread for as long as a client watches a render, and the worker process
+also runs the render queue and its warm worker processes. A sync worker would let
+one open stream block every other request, and its 30s timeout would kill the
+worker, and with it the renders in flight.
+"""
+
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+worker_class = 'gthread'
+# One process: the render queue and warm workers live in it
+workers = int(os.environ.get('WEB_CONCURRENCY', '1'))
+# Each open progress stream occupies a thread until it ends (see EVENTS_MAX_SECONDS)
+threads = int(os.environ.get('GUNICORN_THREADS', '32'))
+# gthread workers heartbeat from their main loop, so this only catches a hung process, not a long request
+timeout = 120
+graceful_timeout = 30
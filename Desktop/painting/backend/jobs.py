@@ -0,0 +1,490 @@
+"""
+Render job queue for the Makart backend.
+
+Uploads are stored as jobs in a local SQLite database and rendered by a bounded
+pool of worker threads, so requests return immediately and queued work survives
+a restart of the server.
+"""
+
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import closing
+
+from render_workers import RenderTimeout, WarmWorkerPool
+from result_cache import ResultCache, file_sha256, render_cache_key
+from uploads import ChunkedUploads
+
+logger = logging.getLogger(__name__)
+
+DATA_DIR = os.environ.get('MAKART_DATA_DIR', os.path.join(tempfile.gettempdir(), 'makart'))
+RENDER_WORKERS = int(os.environ.get('RENDER_WORKERS', '2'))
+JOB_TIMEOUT = int(os.environ.get('JOB_TIMEOUT', '1800'))
+JOB_RETENTION_HOURS = float(os.environ.get('JOB_RETENTION_HOURS', '24'))
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    owner TEXT,
+    params TEXT NOT NULL,
+    work_dir TEXT NOT NULL,
+    input_path TEXT NOT NULL,
+    output_path TEXT NOT NULL,
+    error TEXT,
+    worker_pid INTEGER,
+    worker_token TEXT,
+    cache_key TEXT,
+    progress TEXT,
+    priority INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs (status, created_at);
+"""
+
+# Columns added after the first release, applied to existing databases on startup
+_MIGRATIONS = {
+    'worker_pid': 'ALTER TABLE jobs ADD COLUMN worker_pid INTEGER',
+    'cache_key': 'ALTER TABLE jobs ADD COLUMN cache_key TEXT',
+    'progress': 'ALTER TABLE jobs ADD COLUMN progress TEXT',
+    'priority': 'ALTER TABLE jobs ADD COLUMN priority INTEGER NOT NULL DEFAULT 0',
+    'worker_token': 'ALTER TABLE jobs ADD COLUMN worker_token TEXT',
+}
+
+# Previews are claimed ahead of full renders so they come back within seconds
+PREVIEW_PRIORITY = 1
+
+# Minimum seconds between progress writes within one stage
+PROGRESS_WRITE_INTERVAL = 0.5
+
+# A progress stream closes after this long so it can't hold a server thread for a whole render;
+# EventSource clients reconnect on their own and get the current status straight away
+EVENTS_MAX_SECONDS = int(os.environ.get('EVENTS_MAX_SECONDS', '300'))
+
+
+class JobStore:
+    """SQLite-backed job table, safe to share between threads and gunicorn workers"""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        with closing(self._connect()) as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(_SCHEMA)
+            columns = {row['name'] for row in conn.execute('PRAGMA table_info(jobs)')}
+            for column, statement in _MIGRATIONS.items():
+                if column not in columns:
+                    conn.execute(statement)
+            conn.execute('CREATE INDEX IF NOT EXISTS jobs_cache_key ON jobs (cache_key, status)')
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def create(self, job_id, params, work_dir, input_path, output_path, owner=None, status=QUEUED, cache_key=None,
+               priority=0):
+        now = time.time()
+        finished_at = now if status in (DONE, FAILED) else None
+        with closing(self._connect()) as conn:
+            conn.execute(
+                'INSERT INTO jobs (id, status, owner, params, work_dir, input_path, output_path, cache_key, '
+                'priority, created_at, started_at, finished_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (job_id, status, owner, json.dumps(params), work_dir, input_path, output_path, cache_key,
+                 priority, now, finished_at, finished_at))
+        return self.get(job_id)
+
+    def create_or_attach(self, job_id, params, work_dir, input_path, output_path, owner, cache_key, priority=0):
+        """Queue a job, unless the same owner already has one in flight for cache_key.
+
+        Returns (job, attached).
+        """
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute(
+                'SELECT id FROM jobs WHERE cache_key = ? AND owner IS ? AND status IN (?, ?) '
+                'ORDER BY created_at LIMIT 1', (cache_key, owner, QUEUED, RUNNING)).fetchone()
+            if row is None:
+                conn.execute(
+                    'INSERT INTO jobs (id, status, owner, params, work_dir, input_path, output_path, cache_key, '
+                    'priority, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (job_id, QUEUED, owner, json.dumps(params), work_dir, input_path, output_path, cache_key,
+                     priority, time.time()))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+        if row is not None:
+            return self.get(row['id']), True
+        return self.get(job_id), False
+
+    def get(self, job_id):
+        with closing(self._connect()) as conn:
+            row = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return _row_to_job(row)
+
+    def claim(self):
+        """Atomically move the next queued job (highest priority, then oldest) to running and return it"""
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute(
+                'SELECT * FROM jobs WHERE status = ? ORDER BY priority DESC, created_at LIMIT 1', (QUEUED,)).fetchone()
+            if row is None:
+                conn.execute('COMMIT')
+                return None
+            conn.execute('UPDATE jobs SET status = ?, started_at = ?, worker_pid = ?, worker_token = ? WHERE id = ?',
+                         (RUNNING, time.time(), os.getpid(), _process_token(os.getpid()), row['id']))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+        return self.get(row['id'])
+
+    def finish(self, job_id, status, error=None, progress=None):
+        with closing(self._connect()) as conn:
+            conn.execute('UPDATE jobs SET status = ?, error = ?, finished_at = ?, progress = COALESCE(?, progress) '
+                         'WHERE id = ?',
+                         (status, error, time.time(), json.dumps(progress) if progress else None, job_id))
+
+    def set_progress(self, job_id, progress):
+        with closing(self._connect()) as conn:
+            conn.execute('UPDATE jobs SET progress = ? WHERE id = ?', (json.dumps(progress), job_id))
+
+    def queue_position(self, job):
+        with closing(self._connect()) as conn:
+            return conn.execute('SELECT COUNT(*) FROM jobs WHERE status = ? AND '
+                                '(priority > ? OR (priority = ? AND created_at < ?))',
+                                (QUEUED, job['priority'], job['priority'], job['created_at'])).fetchone()[0]
+
+    def requeue_interrupted(self):
+        """Jobs left running by a process that no longer exists go back to the queue.
+
+        Called once at startup, before this process claims anything.
+        """
+        with closing(self._connect()) as conn:
+            rows = conn.execute('SELECT id, worker_pid, worker_token FROM jobs WHERE status = ?', (RUNNING,)).fetchall()
+            orphaned = [row['id'] for row in rows if not _claimant_alive(row['worker_pid'], row['worker_token'])]
+            for job_id in orphaned:
+                conn.execute('UPDATE jobs SET status = ?, started_at = NULL, worker_pid = NULL, worker_token = NULL '
+                             'WHERE id = ? AND status = ?', (QUEUED, job_id, RUNNING))
+        return len(orphaned)
+
+    def expired(self, cutoff):
+        with closing(self._connect()) as conn:
+            rows = conn.execute('SELECT * FROM jobs WHERE status IN (?, ?) AND finished_at < ?',
+                                (DONE, FAILED, cutoff)).fetchall()
+        return [_row_to_job(row) for row in rows]
+
+    def delete(self, job_id):
+        with closing(self._connect()) as conn:
+            conn.execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+
+
+def _read_boot_id():
+    try:
+        with open('/proc/sys/kernel/random/boot_id') as f:
+            return f.read().strip()
+    except OSError:
+        return ''
+
+
+_BOOT_ID = _read_boot_id()
+_HAS_PROC = os.path.exists('/proc/self/stat')
+
+
+def _process_token(pid):
+    """Identity of a running process that survives PID reuse: boot, pid and start time. None once it has exited.
+
+    Containers restart with the same PIDs, so a live pid alone doesn't mean the claimant is still running.
+    """
+    if not _HAS_PROC:
+        return str(pid) if _pid_alive(pid) else None
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            stat = f.read()
+    except OSError:
+        return None
+    # Fields after the parenthesised command name start at field 3; starttime is field 22
+    return f"{_BOOT_ID}:{pid}:{stat.rsplit(')', 1)[1].split()[19]}"
+
+
+def _claimant_alive(pid, token):
+    if not pid or pid == os.getpid():
+        # Our own pid on a job at startup is a previous incarnation of this process
+        return False
+    if token is None:
+        # Claimed before tokens were recorded
+        return _pid_alive(pid)
+    return _process_token(pid) == token
+
+
+def _pid_alive(pid):
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _row_to_job(row):
+    if row is None:
+        return None
+    job = dict(row)
+    job['params'] = json.loads(job['params'])
+    job['progress'] = json.loads(job['progress']) if job.get('progress') else None
+    return job
+
+
+class ProgressRecorder:
+    """Turns renderer progress events into the job's stored progress, with per-stage timings"""
+
+    def __init__(self, store, job_id):
+        self.store = store
+        self.job_id = job_id
+        self.stage = None
+        self.stage_started = None
+        self.written_at = 0.0
+        self.state = {'stage': None, 'stages': {}}
+
+    def _close_stage(self, now):
+        if self.stage is not None:
+            self.state['stages'][self.stage] = round(now - self.stage_started, 3)
+
+    def __call__(self, event):
+        now = time.time()
+        new_stage = event['stage'] != self.stage
+        if new_stage:
+            self._close_stage(now)
+            self.stage = event['stage']
+            self.stage_started = now
+        self.state.update({key: value for key, value in event.items() if key != 'stage'})
+        self.state['stage'] = self.stage
+        self.state['stage_started_at'] = self.stage_started
+        if event.get('total'):
+            self.state['percent'] = round(100 * event['current'] / event['total'], 1)
+        if new_stage or now - self.written_at >= PROGRESS_WRITE_INTERVAL:
+            self.store.set_progress(self.job_id, self.state)
+            self.written_at = now
+
+    def summary(self):
+        """Final progress with the last stage's duration closed off, stored alongside the job's status"""
+        self._close_stage(time.time())
+        self.stage = None
+        self.state.pop('stage_started_at', None)
+        self.state['stage'] = None
+        return self.state
+
+
+_warm_pool = None
+_warm_pool_lock = threading.Lock()
+
+
+def run_render_warm(job, on_progress=None):
+    """Render one job on a long-lived worker process that keeps the renderer loaded"""
+    global _warm_pool
+    with _warm_pool_lock:
+        if _warm_pool is None:
+            _warm_pool = WarmWorkerPool(RENDER_WORKERS)
+    params = job['params']
+    _warm_pool.render(timeout=JOB_TIMEOUT, on_progress=on_progress,
+                      input_path=job['input_path'], output_path=job['output_path'],
+                      duration=params['duration'], quality=params['quality'], style=params['style'],
+                      engine=params.get('engine'), preview=params.get('preview', False),
+                      depth_backend=params.get('depth_backend'))
+
+
+class RenderQueue:
+    """Bounded pool of render worker threads consuming the job store"""
+
+    def __init__(self, store, runner=run_render_warm, workers=RENDER_WORKERS, data_dir=DATA_DIR):
+        self.store = store
+        self.runner = runner
+        self.workers = max(1, workers)
+        self.jobs_dir = os.path.join(data_dir, 'jobs')
+        self.results = ResultCache(os.path.join(data_dir, 'results'))
+        self.uploads = ChunkedUploads(os.path.join(data_dir, 'uploads'))
+        self._wake = threading.Event()
+        self._threads = []
+        self._lock = threading.Lock()
+        os.makedirs(self.jobs_dir, exist_ok=True)
+
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+            requeued = self.store.requeue_interrupted()
+            if requeued:
+                logger.info(f"Requeued {requeued} interrupted render job(s)")
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._worker_loop, name=f"render-worker-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            logger.info(f"Started {self.workers} render worker(s)")
+
+    def new_job_dir(self):
+        job_id = uuid.uuid4().hex
+        work_dir = os.path.join(self.jobs_dir, job_id)
+        os.makedirs(work_dir)
+        return job_id, work_dir
+
+    def submit(self, job_id, work_dir, input_path, params, owner=None, image_sha256=None):
+        """Queue a render, answer it from the result cache, or attach to an identical job in flight.
+
+        Returns (job, source) where source is 'queued', 'cache' or 'attached'.
+        """
+        output_path = os.path.join(work_dir, 'animation.mp4')
+        cache_key = render_cache_key(image_sha256 or file_sha256(input_path), params)
+        priority = PREVIEW_PRIORITY if params.get('preview') else 0
+
+        if self.results.fetch(cache_key, output_path):
+            job = self.store.create(job_id, params, work_dir, input_path, output_path, owner,
+                                    status=DONE, cache_key=cache_key, priority=priority)
+            return job, 'cache'
+
+        job, attached = self.store.create_or_attach(job_id, params, work_dir, input_path, output_path,
+                                                    owner, cache_key, priority)
+        if attached:
+            shutil.rmtree(work_dir, ignore_errors=True)
+            return job, 'attached'
+        self._wake.set()
+        return job, 'queued'
+
+    def _worker_loop(self):
+        while True:
+            try:
+                job = self.store.claim()
+                if job is None:
+                    self.purge_expired()
+                    # Other gunicorn workers may enqueue too, so poll even without a wake-up
+                    self._wake.wait(timeout=2)
+                    self._wake.clear()
+                    continue
+                self._run(job)
+            except Exception:
+                # A locked database or a vanished directory must not end the thread, or queued jobs never start
+                logger.exception('Render worker loop failed; retrying')
+                self._wake.wait(timeout=2)
+
+    def _run(self, job):
+        logger.info(f"Rendering job {job['id']} ({job['params']})")
+        progress = ProgressRecorder(self.store, job['id'])
+        try:
+            self.runner(job, on_progress=progress)
+            if not os.path.exists(job['output_path']):
+                raise RuntimeError('Animation file was not generated')
+        except RenderTimeout:
+            logger.error(f"Job {job['id']} timed out")
+            self.store.finish(job['id'], FAILED, 'Animation processing timed out', progress=progress.summary())
+        except Exception as e:
+            logger.error(f"Job {job['id']} failed: {str(e)}")
+            self.store.finish(job['id'], FAILED, str(e), progress=progress.summary())
+        else:
+            logger.info(f"Job {job['id']} completed")
+            if job['cache_key']:
+                try:
+                    self.results.put(job['cache_key'], job['output_path'])
+                except OSError as e:
+                    logger.warning(f"Could not cache result of job {job['id']}: {str(e)}")
+            self.store.finish(job['id'], DONE, progress=progress.summary())
+
+    def purge_expired(self):
+        cutoff = time.time() - JOB_RETENTION_HOURS * 3600
+        for job in self.store.expired(cutoff):
+            shutil.rmtree(job['work_dir'], ignore_errors=True)
+            self.store.delete(job['id'])
+        self.uploads.purge_expired()
+
+
+def job_status(store, job):
+    """Public JSON view of a job"""
+    status = {
+        'job_id': job['id'],
+        'status': job['status'],
+        'duration': job['params'].get('duration'),
+        'quality': job['params'].get('quality'),
+        'style': job['params'].get('style'),
+        'preview': job['params'].get('preview', False),
+        'filename': job['params'].get('filename'),
+        'image': job['params'].get('image'),
+        'created_at': job['created_at'],
+        'started_at': job['started_at'],
+        'finished_at': job['finished_at'],
+        'status_url': f"/api/jobs/{job['id']}",
+    }
+    if job['progress']:
+        status['progress'] = job['progress']
+    if job['status'] == QUEUED:
+        status['queue_position'] = store.queue_position(job)
+    elif job['status'] == DONE:
+        status['download_url'] = f"/api/jobs/{job['id']}/download"
+    elif job['status'] == FAILED:
+        status['error'] = job['error']
+    return status
+
+
+def job_events(store, job_id, poll_interval=0.5, heartbeat=15, max_seconds=None):
+    """Server-Sent Events for a job: a 'status' event whenever it changes, ending with 'done' or 'failed'.
+
+    Progress is read back from the job store, so the stream works from any server process.
+    The stream also ends after max_seconds (EVENTS_MAX_SECONDS); clients reconnect to keep watching.
+    """
+    deadline = time.monotonic() + (EVENTS_MAX_SECONDS if max_seconds is None else max_seconds)
+    last_sent = None
+    last_write = time.monotonic()
+    # Reconnect delay for EventSource once the stream ends, in milliseconds
+    yield 'retry: 1000\n\n'
+    while True:
+        job = store.get(job_id)
+        if job is None:
+            yield 'event: failed\ndata: {"error": "Job not found"}\n\n'
+            return
+        payload = json.dumps(job_status(store, job))
+        if payload != last_sent:
+            event = job['status'] if job['status'] in (DONE, FAILED) else 'status'
+            yield f"event: {event}\ndata: {payload}\n\n"
+            last_sent = payload
+            last_write = time.monotonic()
+            if job['status'] in (DONE, FAILED):
+                return
+        elif time.monotonic() - last_write >= heartbeat:
+            # Comment line, keeps proxies from closing an idle stream
+            yield ': keep-alive\n\n'
+            last_write = time.monotonic()
+        if time.monotonic() >= deadline:
+            return
+        time.sleep(poll_interval)
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_render_queue():
+    """Process-wide render queue, started on first use"""
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            store = JobStore(os.path.join(DATA_DIR, 'jobs.sqlite3'))
+            _queue = RenderQueue(store)
+            _queue.start()
+    return _queue
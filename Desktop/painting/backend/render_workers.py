@@ -0,0 +1,185 @@
+"""
+Warm render worker processes for the Makart backend.
+
+Each worker is a long-lived process that imports the renderer (and, with the full
+engine, torch and the MiDaS model) once, then renders jobs sent to it over a pipe.
+Jobs no longer pay interpreter startup and heavy imports every time.
+"""
+
+import atexit
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+import traceback
+
+logger = logging.getLogger(__name__)
+
+# Fresh interpreters rather than forks of the threaded Flask process
+_mp = multiprocessing.get_context('spawn')
+
+# Minimum seconds between progress messages of the same stage
+PROGRESS_INTERVAL = 0.25
+
+
+class RenderTimeout(Exception):
+    pass
+
+
+def _serve(conn):
+    if hasattr(os, 'setsid'):
+        # Lead a process group of our own, so a kill also reaches the engine's frame pool.
+        # The resource tracker (normally the parent's) is settled first and stays outside
+        # the group: it outlives a kill and unlinks the shared memory a killed render leaves.
+        from multiprocessing import resource_tracker
+        resource_tracker.ensure_running()
+        os.setsid()
+    import animate_painting_premium as renderer
+
+    try:
+        renderer.warm_up()
+    except Exception:
+        # A failed warm-up is retried, and reported, by the first job that needs it
+        traceback.print_exc()
+    while True:
+        try:
+            kwargs = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+        try:
+            ok = renderer.render_animation(progress=_progress_sender(conn), **kwargs)
+            conn.send({'ok': bool(ok), 'error': None if ok else 'Animation generation failed'})
+        except Exception as e:
+            conn.send({'ok': False, 'error': str(e)})
+
+
+def _progress_sender(conn):
+    """Forward renderer progress over the pipe, at most every PROGRESS_INTERVAL within a stage"""
+    last = {'stage': None, 'sent_at': 0.0}
+
+    def send(event):
+        now = time.monotonic()
+        done = event.get('total') is not None and event.get('current') == event.get('total')
+        if event['stage'] == last['stage'] and not done and now - last['sent_at'] < PROGRESS_INTERVAL:
+            return
+        last.update(stage=event['stage'], sent_at=now)
+        conn.send({'progress': event})
+    return send
+
+
+class WarmWorker:
+    def __init__(self):
+        self.process = None
+        self.conn = None
+        self.group = None
+        self.jobs_run = 0
+        self.start()
+
+    def start(self):
+        parent_conn, child_conn = _mp.Pipe()
+        # Not a daemon: the full engine renders frames in its own process pool
+        self.process = _mp.Process(target=_serve, args=(child_conn,), name='makart-render-worker')
+        self.process.start()
+        self.group = None
+        child_conn.close()
+        self.conn = parent_conn
+        logger.info(f"Started render worker process {self.process.pid}")
+
+    def stop(self):
+        if self.process is None:
+            return
+        self.conn.close()
+        self.process.join(timeout=5)
+        self.kill()
+        self.process = None
+
+    def kill(self):
+        """Kill the worker and any frame-pool processes it started"""
+        self._find_group()
+        if self.group is not None:
+            try:
+                os.killpg(self.group, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join()
+
+    def _find_group(self):
+        # The worker calls setsid() as it starts; until then it shares our group, which must never be killed
+        if self.group is None and hasattr(os, 'killpg'):
+            try:
+                if os.getpgid(self.process.pid) == self.process.pid:
+                    self.group = self.process.pid
+            except ProcessLookupError:
+                pass
+
+    def restart(self):
+        if self.process is not None:
+            self.kill()
+        self.process = None
+        self.start()
+
+    def render(self, timeout=None, on_progress=None, **kwargs):
+        self._find_group()
+        if not self.process.is_alive():
+            logger.warning(f"Render worker {self.process.pid} died; restarting")
+            self.restart()
+        self.conn.send(kwargs)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            if not self.conn.poll(remaining):
+                # The job is stuck: kill the process and bring up a fresh one for the next job
+                self.restart()
+                raise RenderTimeout('Animation processing timed out')
+            try:
+                result = self.conn.recv()
+            except EOFError:
+                self.restart()
+                raise RuntimeError('Render worker exited unexpectedly')
+            if 'progress' not in result:
+                break
+            if on_progress is not None:
+                try:
+                    on_progress(result['progress'])
+                except Exception:
+                    logger.exception('Progress callback failed')
+        self.jobs_run += 1
+        if not result['ok']:
+            raise RuntimeError(result['error'])
+
+
+class WarmWorkerPool:
+    """Fixed set of warm workers handed out to render threads one job at a time"""
+
+    def __init__(self, size):
+        self._idle = queue.Queue()
+        self._workers = []
+        self._lock = threading.Lock()
+        self.size = size
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._workers:
+                return
+            for _ in range(self.size):
+                worker = WarmWorker()
+                self._workers.append(worker)
+                self._idle.put(worker)
+            atexit.register(self.shutdown)
+
+    def render(self, timeout=None, on_progress=None, **kwargs):
+        self._ensure_started()
+        worker = self._idle.get()
+        try:
+            worker.render(timeout=timeout, on_progress=on_progress, **kwargs)
+        finally:
+            self._idle.put(worker)
+
+    def shutdown(self):
+        for worker in self._workers:
+            worker.stop()
@@ -0,0 +1,81 @@
+"""
+Finished-render cache for the Makart backend.
+
+MP4s are stored under a hash of the uploaded image bytes and the render
+parameters. Identical submissions reuse the existing video instead of
+rendering again. The cache has a disk budget and evicts the least recently
+used videos first.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import sys
+
+# The cache directory logic is shared with the depth cache, one directory up
+PAINTING_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+if PAINTING_DIR not in sys.path:
+    sys.path.insert(0, PAINTING_DIR)
+from lru_directory import LRUDirectory
+
+RESULT_CACHE_MAX_MB = int(os.environ.get('RESULT_CACHE_MAX_MB', '2048'))
+# Bump when renderer output changes, so stale videos are never served
+RENDER_VERSION = 1
+
+_CACHED_PARAMS = ('duration', 'quality', 'style', 'engine', 'preview', 'depth_backend')
+
+
+def render_cache_key(image_sha256, params):
+    """Content hash of the input image plus everything that affects the rendered video"""
+    material = {name: params.get(name) for name in _CACHED_PARAMS}
+    material['image'] = image_sha256
+    material['version'] = RENDER_VERSION
+    return hashlib.sha256(json.dumps(material, sort_keys=True).encode()).hexdigest()
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def link_or_copy(src, dst):
+    """Hard-link when possible so cache entries and job outputs share disk blocks"""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+class ResultCache(LRUDirectory):
+    suffix = '.mp4'
+
+    def __init__(self, cache_dir, max_bytes=None):
+        super().__init__(cache_dir, max_bytes if max_bytes is not None else RESULT_CACHE_MAX_MB * 1024 * 1024)
+
+    def get(self, key):
+        """Path of the cached video for key, or None"""
+        path = self.path(key)
+        return path if self.touch(path) else None
+
+    def fetch(self, key, dst):
+        """Place the cached video for key at dst; False on a miss"""
+        path = self.get(key)
+        if path is None:
+            return False
+        try:
+            link_or_copy(path, dst)
+        except FileNotFoundError:
+            # Evicted between the lookup and the link
+            return False
+        return True
+
+    def put(self, key, src):
+        def write(tmp_path):
+            os.remove(tmp_path)
+            link_or_copy(src, tmp_path)
+
+        self.store(key, write)
@@ -0,0 +1,310 @@
+"""
+Streaming upload ingest for the Makart backend.
+
+The multipart request body is parsed as it arrives, and the image part is written
+in chunks straight into the job's working directory. Nothing is buffered in memory
+or in a spooled temp file first. The SHA-256 the result cache needs is computed
+along the way. Oversize bodies and files that are not images are rejected from the
+Content-Length header and the first bytes of the file, before the rest is read.
+
+Large paintings can instead be sent as a resumable chunked upload. Chunks are PUT
+in any order, each with its own checksum, and can be retried after a dropped
+connection without resending what already arrived.
+"""
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import time
+import uuid
+
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import Data, Epilogue, Field, File, MultipartDecoder, NeedData
+from werkzeug.utils import secure_filename
+
+from result_cache import file_sha256
+
+CHUNK_SIZE = 256 * 1024
+# Form fields are a handful of short values; anything bigger is not our frontend
+MAX_FIELDS_BYTES = 64 * 1024
+MAX_PARTS = 32
+
+# Leading bytes of the image formats the renderers accept
+IMAGE_SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'\xff\xd8\xff', 'jpeg'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+    (b'BM', 'bmp'),
+    (b'II*\x00', 'tiff'),
+    (b'MM\x00*', 'tiff'),
+)
+SNIFF_BYTES = 12
+
+# Chunked uploads: default and allowed chunk sizes, and how long unfinished uploads are kept
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+MIN_CHUNK_SIZE = 256 * 1024
+MAX_CHUNK_SIZE = 16 * 1024 * 1024
+UPLOAD_RETENTION_HOURS = float(os.environ.get('UPLOAD_RETENTION_HOURS', '24'))
+
+_UPLOAD_ID = re.compile(r'[0-9a-f]{32}')
+_SHA256 = re.compile(r'[0-9a-fA-F]{64}')
+
+
+class UploadError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+class StreamedUpload:
+    def __init__(self):
+        self.fields = {}
+        self.filename = None
+        self.path = None
+        self.format = None
+        self.size = 0
+        self.sha256 = None
+
+
+def sniff_image(head):
+    """Image format named by the first SNIFF_BYTES of a file, or None"""
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    for signature, image_format in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return image_format
+    return None
+
+
+def receive_upload(request, work_dir, max_bytes, file_field='file', allowed_file=None, chunk_size=CHUNK_SIZE):
+    """Stream a multipart upload's file part to work_dir; returns a StreamedUpload.
+
+    Raises UploadError with the HTTP status to answer with. Must run before anything
+    touches request.form or request.files, which would consume the body.
+    """
+    mimetype, options = parse_options_header(request.headers.get('Content-Type', ''))
+    if mimetype != 'multipart/form-data' or not options.get('boundary'):
+        raise UploadError('Expected a multipart/form-data upload')
+    if request.content_length is not None and request.content_length > max_bytes:
+        raise UploadError('File is too large', 413)
+
+    decoder = MultipartDecoder(options['boundary'].encode(), max_parts=MAX_PARTS)
+    upload = StreamedUpload()
+    digest = hashlib.sha256()
+    field = None
+    field_data = []
+    fields_bytes = 0
+    out = None
+    head = b''
+    stream = request.stream
+    try:
+        while True:
+            chunk = stream.read(chunk_size)
+            decoder.receive_data(chunk or None)
+            event = decoder.next_event()
+            while not isinstance(event, NeedData):
+                if isinstance(event, Field):
+                    field, field_data = event.name, []
+                elif isinstance(event, File):
+                    field = None
+                    if event.name == file_field and out is None:
+                        if not event.filename or (allowed_file is not None and not allowed_file(event.filename)):
+                            raise UploadError('Invalid file')
+                        upload.filename = event.filename
+                        upload.path = os.path.join(work_dir, secure_filename(event.filename) or 'upload')
+                        out = open(upload.path, 'wb')
+                elif isinstance(event, Data):
+                    if field is not None:
+                        fields_bytes += len(event.data)
+                        if fields_bytes > MAX_FIELDS_BYTES:
+                            raise UploadError('Form fields are too large', 413)
+                        field_data.append(event.data)
+                        if not event.more_data:
+                            upload.fields[field] = b''.join(field_data).decode('utf-8', 'replace')
+                            field = None
+                    elif out is not None and upload.sha256 is None:
+                        upload.size += len(event.data)
+                        if upload.size > max_bytes:
+                            raise UploadError('File is too large', 413)
+                        if upload.format is None:
+                            head += event.data
+                            if len(head) >= SNIFF_BYTES or not event.more_data:
+                                upload.format = sniff_image(head)
+                                if upload.format is None:
+                                    raise UploadError('File is not a supported image')
+                        digest.update(event.data)
+                        out.write(event.data)
+                        if not event.more_data:
+                            upload.sha256 = digest.hexdigest()
+                elif isinstance(event, Epilogue):
+                    break
+                event = decoder.next_event()
+            if isinstance(event, Epilogue) or not chunk:
+                break
+    except RequestEntityTooLarge:
+        # The body outgrew MAX_CONTENT_LENGTH while being read
+        raise UploadError('File is too large', 413)
+    except ValueError as e:
+        # Malformed multipart body, or too many parts
+        raise UploadError(f'Invalid upload: {e}')
+    finally:
+        if out is not None:
+            out.close()
+    if upload.path is None:
+        raise UploadError('No file uploaded')
+    if upload.sha256 is None:
+        raise UploadError('Upload ended before the file was complete')
+    return upload
+
+
+class ChunkedUploads:
+    """Resumable uploads assembled on local disk.
+
+    Each upload is a directory with a manifest, the file preallocated at its final
+    size, and a marker per received chunk. Chunks are written in place at their
+    offset, so completing an upload moves the file into the job directory without
+    another copy. The markers keep the received set across server restarts and
+    between gunicorn workers.
+    """
+
+    def __init__(self, uploads_dir):
+        self.uploads_dir = uploads_dir
+        os.makedirs(uploads_dir, exist_ok=True)
+
+    def _dir(self, upload_id):
+        return os.path.join(self.uploads_dir, upload_id)
+
+    def create(self, owner, filename, size, params, chunk_size=None, sha256=None):
+        chunk_size = UPLOAD_CHUNK_SIZE if chunk_size is None else chunk_size
+        if not isinstance(size, int) or isinstance(size, bool) or size <= 0:
+            raise UploadError('size must be a positive number of bytes')
+        if sha256 is not None and not (isinstance(sha256, str) and _SHA256.fullmatch(sha256)):
+            raise UploadError('sha256 must be a 64-character hex string')
+        if not isinstance(chunk_size, int) or isinstance(chunk_size, bool) \
+                or not MIN_CHUNK_SIZE <= chunk_size <= MAX_CHUNK_SIZE:
+            raise UploadError(f"chunk_size must be a whole number of bytes between {MIN_CHUNK_SIZE} and {MAX_CHUNK_SIZE}")
+        manifest = {
+            'id': uuid.uuid4().hex,
+            'owner': owner,
+            'filename': filename,
+            'size': size,
+            'chunk_size': chunk_size,
+            'total_chunks': -(-size // chunk_size),
+            'sha256': sha256.lower() if sha256 else None,
+            'params': params,
+            'created_at': time.time(),
+        }
+        upload_dir = self._dir(manifest['id'])
+        os.makedirs(os.path.join(upload_dir, 'chunks'))
+        with open(os.path.join(upload_dir, 'data'), 'wb') as f:
+            f.truncate(size)
+        with open(os.path.join(upload_dir, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f)
+        return manifest
+
+    def get(self, upload_id, owner=None):
+        """Manifest of an unfinished upload belonging to owner, or None"""
+        if not _UPLOAD_ID.fullmatch(upload_id):
+            return None
+        try:
+            with open(os.path.join(self._dir(upload_id), 'manifest.json')) as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            return None
+        if manifest['owner'] != owner:
+            return None
+        return manifest
+
+    def received(self, manifest):
+        try:
+            return sorted(int(name) for name in os.listdir(os.path.join(self._dir(manifest['id']), 'chunks')))
+        except FileNotFoundError:
+            return []
+
+    def status(self, manifest):
+        received = self.received(manifest)
+        done = set(received)
+        return {
+            'upload_id': manifest['id'],
+            'filename': manifest['filename'],
+            'size': manifest['size'],
+            'chunk_size': manifest['chunk_size'],
+            'total_chunks': manifest['total_chunks'],
+            'received': received,
+            'missing': [i for i in range(manifest['total_chunks']) if i not in done],
+        }
+
+    def write_chunk(self, manifest, index, data, checksum):
+        """Store chunk index after checking its length and SHA-256; a repeated chunk overwrites itself"""
+        if not 0 <= index < manifest['total_chunks']:
+            raise UploadError(f"Chunk index must be between 0 and {manifest['total_chunks'] - 1}")
+        offset = index * manifest['chunk_size']
+        expected = min(manifest['chunk_size'], manifest['size'] - offset)
+        if len(data) != expected:
+            raise UploadError(f"Chunk {index} must be {expected} bytes, got {len(data)}")
+        if not checksum or hashlib.sha256(data).hexdigest() != checksum.lower():
+            raise UploadError(f"Checksum mismatch for chunk {index}")
+        if index == 0 and sniff_image(data[:SNIFF_BYTES]) is None:
+            raise UploadError('File is not a supported image')
+        upload_dir = self._dir(manifest['id'])
+        try:
+            fd = os.open(os.path.join(upload_dir, 'data'), os.O_WRONLY)
+        except FileNotFoundError:
+            raise UploadError('Upload not found', 404)
+        try:
+            os.pwrite(fd, data, offset)
+        finally:
+            os.close(fd)
+        # The marker is written last, so a chunk only counts once its bytes are in place
+        open(os.path.join(upload_dir, 'chunks', str(index)), 'w').close()
+
+    def complete(self, manifest, work_dir):
+        """Move a fully received upload into work_dir; returns a StreamedUpload"""
+        status = self.status(manifest)
+        if status['missing']:
+            raise UploadError(f"Upload is missing {len(status['missing'])} chunk(s)", 409)
+        upload_dir = self._dir(manifest['id'])
+        data_path = os.path.join(upload_dir, 'data')
+        upload = StreamedUpload()
+        upload.fields = manifest['params']
+        upload.filename = manifest['filename']
+        upload.size = manifest['size']
+        try:
+            # Verified in place: on a mismatch the upload and its chunks stay, so the client can resend
+            upload.sha256 = file_sha256(data_path)
+            with open(data_path, 'rb') as f:
+                upload.format = sniff_image(f.read(SNIFF_BYTES))
+        except FileNotFoundError:
+            # Another request completed it first
+            raise UploadError('Upload not found', 404)
+        if manifest['sha256'] and upload.sha256 != manifest['sha256']:
+            raise UploadError('Checksum mismatch for the assembled file')
+        upload.path = os.path.join(work_dir, secure_filename(manifest['filename']) or 'upload')
+        try:
+            os.replace(data_path, upload.path)
+        except FileNotFoundError:
+            raise UploadError('Upload not found', 404)
+        shutil.rmtree(upload_dir, ignore_errors=True)
+        return upload
+
+    def discard(self, upload_id):
+        shutil.rmtree(self._dir(upload_id), ignore_errors=True)
+
+    def purge_expired(self):
+        """Remove uploads that have received no new chunk for UPLOAD_RETENTION_HOURS"""
+        cutoff = time.time() - UPLOAD_RETENTION_HOURS * 3600
+        # The default data directory lives under the system temp dir, which tmp cleaners may empty
+        os.makedirs(self.uploads_dir, exist_ok=True)
+        for name in os.listdir(self.uploads_dir):
+            path = self._dir(name)
+            try:
+                # A new chunk marker bumps the mtime of the chunks directory
+                expired = os.path.getmtime(os.path.join(path, 'chunks')) < cutoff
+            except FileNotFoundError:
+                continue
+            if expired:
+                shutil.rmtree(path, ignore_errors=True)
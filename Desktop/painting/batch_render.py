@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+Batch Renderer
+Renders a set of paintings across a matrix of styles, durations and qualities without prompts
+
+    python batch_render.py paintings/ --styles ethereal,particle_powder --durations 5,10 --qualities good,premium
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import style_engine
+from style_selector import StyleSelector
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.tiff', '.webp')
+FPS = 30
+
+# Quality name -> (bitrate, CRF, max image size), the same presets the interactive selector offers
+QUALITIES = {name: (bitrate, crf, max_size) for name, bitrate, crf, max_size, _ in StyleSelector().qualities.values()}
+
+
+def find_images(source):
+    """Image paths from a directory, or from a manifest file with one path per line"""
+    if os.path.isdir(source):
+        return sorted(os.path.join(source, name) for name in os.listdir(source)
+                      if name.lower().endswith(IMAGE_EXTENSIONS))
+    base = os.path.dirname(os.path.abspath(source))
+    with open(source) as f:
+        if source.endswith('.json'):
+            entries = json.load(f)
+        else:
+            entries = [line.strip() for line in f if line.strip() and not line.lstrip().startswith('#')]
+    return [entry if os.path.isabs(entry) else os.path.join(base, entry) for entry in entries]
+
+
+def plan_jobs(images, styles, durations, qualities, output_dir, max_size=None):
+    """One job per combination; max_size overrides each quality's own image size"""
+    jobs = []
+    for image in images:
+        stem = os.path.splitext(os.path.basename(image))[0]
+        for style in styles:
+            for duration in durations:
+                for quality in qualities:
+                    output = os.path.join(output_dir, f"{stem}_{style}_{duration:g}s_{quality}.mp4")
+                    jobs.append({'image': image, 'style': style, 'duration': duration, 'quality': quality,
+                                 'max_size': max_size or QUALITIES[quality][2], 'output': output})
+    return jobs
+
+
+def _quietly(verbose, fn, *args, **kwargs):
+    # Renders running side by side would interleave their progress output
+    if verbose:
+        return fn(*args, **kwargs)
+    with contextlib.redirect_stdout(io.StringIO()):
+        return fn(*args, **kwargs)
+
+
+def _depth_task(image, max_size, depth_backend, verbose):
+    start = time.perf_counter()
+    timings = _quietly(verbose, style_engine.prepare_depth, image, max_size, depth_backend)
+    return {'seconds': round(time.perf_counter() - start, 2), 'cache': timings['cache']}
+
+
+def _render_task(job, depth_backend, verbose):
+    bitrate, crf, _ = QUALITIES[job['quality']]
+    start = time.perf_counter()
+    # One process per job already fills the cores, so frames render sequentially inside it
+    _quietly(verbose, style_engine.render, job['image'], job['output'], style=job['style'],
+             num_frames=int(job['duration'] * FPS), bitrate=bitrate, crf=crf, max_size=job['max_size'], workers=1,
+             depth_backend=depth_backend)
+    return {'seconds': round(time.perf_counter() - start, 2)}
+
+
+def run_batch(jobs, processes, depth_backend=None, verbose=False):
+    """Render jobs on a process pool; each image's depth is computed once per size, before its renders start"""
+    by_depth = {}
+    for job in jobs:
+        by_depth.setdefault((job['image'], job['max_size']), []).append(job)
+
+    depth = {}
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        pending = {pool.submit(_depth_task, image, max_size, depth_backend, verbose): ('depth', (image, max_size))
+                   for image, max_size in by_depth}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                kind, item = pending.pop(future)
+                if kind == 'depth':
+                    image, max_size = item
+                    sizes = depth.setdefault(image, {})
+                    try:
+                        sizes[max_size] = future.result()
+                    except Exception as e:
+                        sizes[max_size] = {'error': str(e)}
+                        for job in by_depth[item]:
+                            job.update(status='failed', error=f"Depth estimation failed: {e}")
+                            print(f"❌ {os.path.basename(job['output'])}: {job['error']}")
+                        continue
+                    for job in by_depth[item]:
+                        pending[pool.submit(_render_task, job, depth_backend, verbose)] = ('render', job)
+                else:
+                    try:
+                        item.update(status='done', **future.result())
+                        print(f"✅ {os.path.basename(item['output'])} in {item['seconds']:.1f}s")
+                    except Exception as e:
+                        item.update(status='failed', error=str(e))
+                        print(f"❌ {os.path.basename(item['output'])}: {e}")
+    return depth
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Render many paintings across styles, durations and qualities")
+    parser.add_argument('source', help="directory of images, or a manifest (.txt with one path per line, or .json list)")
+    parser.add_argument('--styles', default='particle_powder',
+                        help=f"comma-separated, from: {', '.join(style_engine.STYLES)}")
+    parser.add_argument('--durations', default='10', help="comma-separated seconds")
+    parser.add_argument('--qualities', default='premium', help=f"comma-separated, from: {', '.join(QUALITIES)}")
+    parser.add_argument('--output-dir', default='renders')
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--max-size', type=int, help="longest image side in pixels (default: set by each quality)")
+    parser.add_argument('--depth-backend', choices=('torch', 'onnx'), help="default: DEPTH_BACKEND or torch")
+    parser.add_argument('--skip-existing', action='store_true', help="leave videos that already exist alone")
+    parser.add_argument('--verbose', action='store_true', help="show each render's own progress output")
+    args = parser.parse_args(argv)
+
+    styles = [s.strip() for s in args.styles.split(',') if s.strip()]
+    qualities = [q.strip() for q in args.qualities.split(',') if q.strip()]
+    durations = [float(d) for d in args.durations.split(',') if d.strip()]
+    unknown = [s for s in styles if s not in style_engine.STYLES] + [q for q in qualities if q not in QUALITIES]
+    if unknown:
+        parser.error(f"unknown style or quality: {', '.join(unknown)}")
+
+    images = find_images(args.source)
+    missing = [image for image in images if not os.path.exists(image)]
+    if missing:
+        parser.error(f"images not found: {', '.join(missing)}")
+    if not images:
+        parser.error(f"no images found in {args.source}")
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    jobs = plan_jobs(images, styles, durations, qualities, args.output_dir, args.max_size)
+    skipped = []
+    if args.skip_existing:
+        skipped = [job for job in jobs if os.path.exists(job['output'])]
+        jobs = [job for job in jobs if not os.path.exists(job['output'])]
+        for job in skipped:
+            job['status'] = 'skipped'
+
+    print(f"🎨 {len(jobs)} renders of {len(images)} paintings on {args.processes} processes"
+          + (f" ({len(skipped)} already rendered)" if skipped else ""))
+    start = time.perf_counter()
+    depth = run_batch(jobs, args.processes, args.depth_backend, args.verbose)
+    wall_seconds = time.perf_counter() - start
+
+    results = skipped + jobs
+    failed = [job for job in results if job.get('status') == 'failed']
+    summary = {
+        'wall_seconds': round(wall_seconds, 2),
+        'processes': args.processes,
+        'rendered': sum(job.get('status') == 'done' for job in results),
+        'failed': len(failed),
+        'skipped': len(skipped),
+        'depth': depth,
+        'jobs': results,
+    }
+    summary_path = os.path.join(args.output_dir, 'summary.json')
+    with open(summary_path, 'w') as f:
+        json.dump(summary, f, indent=2)
+
+    render_seconds = sum(job.get('seconds', 0) for job in results)
+    print(f"🌟 {summary['rendered']} rendered, {len(failed)} failed in {wall_seconds:.1f}s "
+          f"({render_seconds:.1f}s of render time)")
+    print(f"📋 Summary: {summary_path}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
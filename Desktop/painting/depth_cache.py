@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Depth Map Cache
+Content-addressed on-disk cache for normalized depth maps, shared by every render of the same painting
+"""
+
+import hashlib
+import os
+
+import numpy as np
+
+from lru_directory import LRUDirectory
+
+DEPTH_CACHE_DIR = os.environ.get('DEPTH_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'makart', 'depth'))
+DEPTH_CACHE_MAX_MB = int(os.environ.get('DEPTH_CACHE_MAX_MB', '512'))
+
+
+def depth_cache_key(img_np, model_type, resolution=None):
+    """Hash of the working-resolution pixels plus the model that produced the depth"""
+    img_np = np.ascontiguousarray(img_np)
+    resolution = resolution or img_np.shape[:2]
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(f"{model_type}|{resolution[0]}x{resolution[1]}|{img_np.shape}|{img_np.dtype.str}|".encode())
+    digest.update(img_np.data)
+    return digest.hexdigest()
+
+
+class DepthCache(LRUDirectory):
+    suffix = '.npy'
+
+    def __init__(self, cache_dir=None, max_bytes=None):
+        super().__init__(cache_dir or DEPTH_CACHE_DIR,
+                         max_bytes if max_bytes is not None else DEPTH_CACHE_MAX_MB * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Memory-mapped float16 depth map, or None on a miss"""
+        path = self.path(key)
+        try:
+            depth = np.load(path, mmap_mode='r')
+        except (FileNotFoundError, ValueError, OSError):
+            self.misses += 1
+            return None
+        self.touch(path)
+        self.hits += 1
+        return depth
+
+    def put(self, key, depth):
+        stored = np.asarray(depth, dtype=np.float16)
+
+        def write(tmp_path):
+            # A file object, because np.save() would append .npy to the temp name
+            with open(tmp_path, 'wb') as f:
+                np.save(f, stored)
+
+        self.store(key, write)
+        try:
+            return np.load(self.path(key), mmap_mode='r')
+        except (FileNotFoundError, ValueError, OSError):
+            return stored
+
+    def get_or_compute(self, img_np, model_type, compute, resolution=None):
+        """Cached depth for img_np, calling compute(img_np) only on a miss"""
+        key = depth_cache_key(img_np, model_type, resolution)
+        depth = self.get(key)
+        if depth is None:
+            # Hand back the stored float16 copy so hits and misses render identically
+            depth = self.put(key, compute(img_np))
+        return depth
+
+
+_default_cache = None
+
+
+def get_depth_cache():
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = DepthCache()
+    return _default_cache
@@ -0,0 +1,391 @@
+#!/usr/bin/env python3
+"""
+Depth Estimation Service
+Loads the MiDaS depth model once per worker process and keeps it warm across jobs.
+Runs on PyTorch, or on ONNX Runtime from an exported graph without importing torch.
+"""
+
+import os
+import threading
+import time
+
+import numpy as np
+
+# Local MiDaS sources and weights, so workers don't depend on GitHub or the hub cache
+MIDAS_REPO_PATH = os.environ.get('MIDAS_REPO_PATH')
+MIDAS_WEIGHTS_PATH = os.environ.get('MIDAS_WEIGHTS_PATH')
+# Graph written by export_onnx(), used by the 'onnx' backend
+MIDAS_ONNX_PATH = os.environ.get('MIDAS_ONNX_PATH')
+DEFAULT_MODEL = 'MiDaS_small'
+DEPTH_BACKEND = os.environ.get('DEPTH_BACKEND', 'torch')
+BACKENDS = ('torch', 'onnx')
+# Images whose longest side reaches this many pixels get tiled depth (0 disables)
+DEPTH_TILE_THRESHOLD = int(os.environ.get('DEPTH_TILE_THRESHOLD', '1600'))
+# Tiles run through the model together, at most this many at a time
+DEPTH_TILE_BATCH = int(os.environ.get('DEPTH_TILE_BATCH', '8'))
+
+# Square input size each model's transform resizes to
+MODEL_RESOLUTION = {
+    'MiDaS_small': 256,
+    'DPT_Hybrid': 384,
+    'DPT_Large': 384,
+}
+
+_TRANSFORMS = {
+    'MiDaS_small': 'small_transform',
+    'DPT_Hybrid': 'dpt_transform',
+    'DPT_Large': 'dpt_transform',
+}
+
+# The same preprocessing as those MiDaS transforms, for running without torch:
+# (resize method, normalization mean, normalization std)
+_PREPROCESSING = {
+    'MiDaS_small': ('upper_bound', (0.485, 0.456, 0.406), (0.229, 0.224, 0.225)),
+    'DPT_Hybrid': ('minimal', (0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
+    'DPT_Large': ('minimal', (0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
+}
+
+
+class DepthModel:
+    def __init__(self, model_type=DEFAULT_MODEL, repo_path=None, weights_path=None):
+        self.model_type = model_type
+        self.repo_path = repo_path or MIDAS_REPO_PATH
+        self.weights_path = weights_path or MIDAS_WEIGHTS_PATH
+        self.model = None
+        self.transform = None
+        self.load_seconds = None
+        self.last_inference_seconds = None
+        self.inference_count = 0
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self.model is not None
+
+    def load(self):
+        """Build the network and its input transform; a no-op once loaded"""
+        with self._lock:
+            if self.model is not None:
+                return self
+            import torch
+
+            start = time.perf_counter()
+            if self.repo_path:
+                # A local clone of intel-isl/MiDaS: no network, weights from disk if given
+                model = torch.hub.load(self.repo_path, self.model_type, source='local',
+                                       pretrained=self.weights_path is None)
+                transforms = torch.hub.load(self.repo_path, 'transforms', source='local')
+            else:
+                model = torch.hub.load('intel-isl/MiDaS', self.model_type, pretrained=self.weights_path is None)
+                transforms = torch.hub.load('intel-isl/MiDaS', 'transforms')
+            if self.weights_path:
+                model.load_state_dict(torch.load(self.weights_path, map_location='cpu'))
+            model.eval()
+
+            self.transform = getattr(transforms, _TRANSFORMS.get(self.model_type, 'default_transform'))
+            self.model = model
+            self.load_seconds = time.perf_counter() - start
+            return self
+
+    def predict(self, img_np):
+        """Raw model output for an RGB uint8 array, at the model's working resolution"""
+        import torch
+
+        self.load()
+        start = time.perf_counter()
+        with torch.no_grad():
+            depth = self.model(self.transform(img_np)).squeeze().cpu().numpy()
+        self.last_inference_seconds = time.perf_counter() - start
+        self.inference_count += 1
+        return depth
+
+    def predict_batch(self, images):
+        """Raw model output for equally sized RGB uint8 arrays, as one (N, h, w) array"""
+        import torch
+
+        self.load()
+        start = time.perf_counter()
+        with torch.no_grad():
+            depth = self.model(torch.cat([self.transform(img) for img in images])).cpu().numpy()
+        self.last_inference_seconds = time.perf_counter() - start
+        self.inference_count += len(images)
+        return depth.reshape(len(images), *depth.shape[-2:])
+
+    def estimate(self, img_np):
+        """Depth map resized to the image and normalized to 0..1"""
+        import cv2
+
+        h, w = img_np.shape[:2]
+        depth = cv2.resize(self.predict(img_np), (w, h))
+        return cv2.normalize(depth, None, 0, 1, cv2.NORM_MINMAX)
+
+    def estimate_tiled(self, img_np, tile_size=None, overlap=None, batch_size=None):
+        """Full-resolution depth from overlapping tiles, normalized to 0..1.
+
+        A whole-image pass fixes the global layout. Each tile's prediction is fitted
+        to it with a least-squares scale and shift, because MiDaS depth is only
+        relative within one input. The fitted tiles are then blended with weights
+        that fade out over the overlap. Cost grows with image area, and only the
+        output and weight maps are held at full size.
+        """
+        import cv2
+
+        h, w = img_np.shape[:2]
+        # Tiles match the model's input size, so the transform feeds them in without downscaling
+        tile_size = min(tile_size or MODEL_RESOLUTION.get(self.model_type, 384), h, w)
+        overlap = min(overlap if overlap is not None else tile_size // 4, tile_size // 2)
+        batch_size = batch_size or DEPTH_TILE_BATCH
+        start = time.perf_counter()
+
+        coarse = cv2.resize(self.predict(img_np), (w, h))
+        feather = _feather(tile_size, overlap)
+        depth = np.zeros((h, w), dtype=np.float32)
+        weight = np.zeros((h, w), dtype=np.float32)
+        origins = [(y, x) for y in _tile_starts(h, tile_size, overlap) for x in _tile_starts(w, tile_size, overlap)]
+        for i in range(0, len(origins), batch_size):
+            batch = origins[i:i + batch_size]
+            tiles = [img_np[y:y + tile_size, x:x + tile_size] for y, x in batch]
+            for (y, x), raw in zip(batch, self.predict_batch(tiles)):
+                tile = cv2.resize(raw, (tile_size, tile_size))
+                target = coarse[y:y + tile_size, x:x + tile_size]
+                scale, shift = _fit_scale_shift(tile[::4, ::4], target[::4, ::4])
+                depth[y:y + tile_size, x:x + tile_size] += (tile * scale + shift) * feather
+                weight[y:y + tile_size, x:x + tile_size] += feather
+        depth /= weight
+
+        self.last_inference_seconds = time.perf_counter() - start
+        return cv2.normalize(depth, None, 0, 1, cv2.NORM_MINMAX)
+
+    def timings(self):
+        return {
+            'model': self.model_type,
+            'backend': 'torch',
+            'load_seconds': self.load_seconds,
+            'inference_seconds': self.last_inference_seconds,
+            'inference_count': self.inference_count,
+        }
+
+
+def _tile_starts(length, tile_size, overlap):
+    # Evenly stepped tiles, with the last one flush against the far edge
+    stride = tile_size - overlap
+    starts = list(range(0, max(length - tile_size, 0) + 1, stride))
+    if starts[-1] + tile_size < length:
+        starts.append(length - tile_size)
+    return starts
+
+
+def _feather(tile_size, overlap):
+    # Weight ramps from ~0 at a tile's border to 1 at the overlap width
+    ramp = np.minimum(np.arange(tile_size) + 1, tile_size - np.arange(tile_size)) / max(overlap, 1)
+    ramp = np.clip(ramp, 1e-3, 1).astype(np.float32)
+    return np.outer(ramp, ramp)
+
+
+def _fit_scale_shift(source, target):
+    # Least-squares scale and shift mapping source onto target
+    source = source.ravel().astype(np.float64)
+    target = target.ravel().astype(np.float64)
+    variance = source.var()
+    if variance < 1e-12:
+        return 0.0, float(target.mean())
+    scale = float(((source - source.mean()) * (target - target.mean())).mean() / variance)
+    return scale, float(target.mean() - scale * source.mean())
+
+
+def _multiple_of(x, multiple=32, max_val=None):
+    y = int(np.round(x / multiple) * multiple)
+    if max_val is not None and y > max_val:
+        y = int(np.floor(x / multiple) * multiple)
+    return y
+
+
+def preprocess(img_np, model_type=DEFAULT_MODEL):
+    """NCHW float32 network input for an RGB uint8 array, matching the MiDaS torch transforms"""
+    import cv2
+
+    method, mean, std = _PREPROCESSING.get(model_type, _PREPROCESSING[DEFAULT_MODEL])
+    size = MODEL_RESOLUTION.get(model_type, 384)
+    h, w = img_np.shape[:2]
+    scale_h, scale_w = size / h, size / w
+    if method == 'upper_bound':
+        scale_h = scale_w = min(scale_h, scale_w)
+        new_h, new_w = _multiple_of(scale_h * h, max_val=size), _multiple_of(scale_w * w, max_val=size)
+    else:
+        scale_h = scale_w = scale_w if abs(1 - scale_w) < abs(1 - scale_h) else scale_h
+        new_h, new_w = _multiple_of(scale_h * h), _multiple_of(scale_w * w)
+
+    image = cv2.resize(img_np / 255.0, (new_w, new_h), interpolation=cv2.INTER_CUBIC)
+    image = (image - np.array(mean)) / np.array(std)
+    return np.ascontiguousarray(image.transpose(2, 0, 1))[None].astype(np.float32)
+
+
+class OnnxDepthModel(DepthModel):
+    """MiDaS exported to ONNX and run on ONNX Runtime's CPU provider; torch is never imported"""
+
+    def __init__(self, model_type=DEFAULT_MODEL, onnx_path=None):
+        super().__init__(model_type)
+        self.onnx_path = onnx_path or MIDAS_ONNX_PATH
+        self.input_name = None
+
+    def load(self):
+        with self._lock:
+            if self.model is not None:
+                return self
+            if not self.onnx_path:
+                raise RuntimeError("The onnx depth backend needs MIDAS_ONNX_PATH (see export_onnx)")
+            import onnxruntime
+
+            start = time.perf_counter()
+            options = onnxruntime.SessionOptions()
+            options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+            session = onnxruntime.InferenceSession(self.onnx_path, options, providers=['CPUExecutionProvider'])
+            self.input_name = session.get_inputs()[0].name
+            self.model = session
+            self.load_seconds = time.perf_counter() - start
+            return self
+
+    def predict(self, img_np):
+        self.load()
+        start = time.perf_counter()
+        depth = self.model.run(None, {self.input_name: preprocess(img_np, self.model_type)})[0].squeeze()
+        self.last_inference_seconds = time.perf_counter() - start
+        self.inference_count += 1
+        return depth
+
+    def predict_batch(self, images):
+        self.load()
+        start = time.perf_counter()
+        inputs = [preprocess(img, self.model_type) for img in images]
+        if isinstance(self.model.get_inputs()[0].shape[0], int):
+            # Graph exported with a fixed batch size of one
+            outputs = [self.model.run(None, {self.input_name: x})[0] for x in inputs]
+        else:
+            outputs = [self.model.run(None, {self.input_name: np.concatenate(inputs)})[0]]
+        depth = np.concatenate([out.reshape(-1, *out.shape[-2:]) for out in outputs])
+        self.last_inference_seconds = time.perf_counter() - start
+        self.inference_count += len(images)
+        return depth
+
+    def timings(self):
+        return {**super().timings(), 'backend': 'onnx'}
+
+
+def export_onnx(output_path, model_type=DEFAULT_MODEL, opset=17):
+    """Export the torch MiDaS model to ONNX, with dynamic batch, height and width, for the onnx backend"""
+    import torch
+
+    model = get_depth_model(model_type, backend='torch').model
+    size = MODEL_RESOLUTION.get(model_type, 384)
+    dummy = torch.zeros(1, 3, size, size)
+    torch.onnx.export(model, dummy, output_path, opset_version=opset, input_names=['image'],
+                      output_names=['depth'],
+                      dynamic_axes={'image': {0: 'batch', 2: 'height', 3: 'width'},
+                                    'depth': {0: 'batch', 1: 'height', 2: 'width'}})
+    return output_path
+
+
+def check_parity(img_np, model_type=DEFAULT_MODEL, onnx_path=None, tolerance=1e-3):
+    """Compare normalized depth from the onnx backend against torch; returns the differences and a verdict"""
+    reference = get_depth_model(model_type, backend='torch').estimate(img_np)
+    candidate = get_depth_model(model_type, backend='onnx', onnx_path=onnx_path).estimate(img_np)
+    difference = np.abs(np.asarray(reference, dtype=np.float64) - np.asarray(candidate, dtype=np.float64))
+    return {
+        'max_abs_diff': float(difference.max()),
+        'mean_abs_diff': float(difference.mean()),
+        'correlation': float(np.corrcoef(reference.ravel(), candidate.ravel())[0, 1]),
+        'ok': bool(difference.max() <= tolerance),
+    }
+
+
+_models = {}
+_models_lock = threading.Lock()
+
+
+def get_depth_model(model_type=DEFAULT_MODEL, repo_path=None, weights_path=None, backend=None, onnx_path=None):
+    """Process-wide depth model for these settings, loaded on first use"""
+    backend = backend or DEPTH_BACKEND
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown depth backend: {backend}")
+    if backend == 'onnx':
+        key = (backend, model_type, onnx_path or MIDAS_ONNX_PATH)
+    else:
+        key = (backend, model_type, repo_path or MIDAS_REPO_PATH, weights_path or MIDAS_WEIGHTS_PATH)
+    with _models_lock:
+        if key not in _models:
+            if backend == 'onnx':
+                _models[key] = OnnxDepthModel(model_type, onnx_path)
+            else:
+                _models[key] = DepthModel(model_type, repo_path, weights_path)
+        model = _models[key]
+    return model.load()
+
+
+def estimate_depth(img_np, model_type=DEFAULT_MODEL, use_cache=True, backend=None, tiled=None):
+    """Normalized float32 depth for img_np plus timings, served from the depth cache when possible.
+
+    tiled=None tiles images whose longest side reaches DEPTH_TILE_THRESHOLD.
+    """
+    backend = backend or DEPTH_BACKEND
+    if tiled is None:
+        tiled = DEPTH_TILE_THRESHOLD > 0 and max(img_np.shape[:2]) >= DEPTH_TILE_THRESHOLD
+    timings = {'model': model_type, 'backend': backend, 'tiled': tiled, 'cache': 'off', 'load_seconds': None,
+               'inference_seconds': None}
+
+    def compute(image):
+        model = get_depth_model(model_type, backend=backend)
+        depth = model.estimate_tiled(image) if tiled else model.estimate(image)
+        timings.update(cache='miss' if use_cache else 'off',
+                       load_seconds=model.load_seconds, inference_seconds=model.last_inference_seconds)
+        return depth
+
+    if use_cache:
+        from depth_cache import get_depth_cache
+
+        timings['cache'] = 'hit'
+        # Backends agree only to float tolerance, so each keeps its own cache entries
+        cache_model = model_type if backend == 'torch' else f"{model_type}+{backend}"
+        if tiled:
+            cache_model += '+tiled'
+        depth = get_depth_cache().get_or_compute(img_np, cache_model, compute,
+                                                 resolution=(MODEL_RESOLUTION.get(model_type, 0),) * 2)
+    else:
+        depth = compute(img_np)
+    return np.asarray(depth, dtype=np.float32), timings
+
+
+if __name__ == "__main__":
+    # Warm-up / smoke check:  python depth_service.py painting.jpg [--backend onnx]
+    # Export for onnx:        python depth_service.py --export-onnx midas_small.onnx
+    # Backend parity check:   python depth_service.py painting.jpg --parity --onnx-path midas_small.onnx
+    import argparse
+    import sys
+    from PIL import Image
+
+    parser = argparse.ArgumentParser(description="MiDaS depth service")
+    parser.add_argument('image', nargs='?')
+    parser.add_argument('--model', default=DEFAULT_MODEL)
+    parser.add_argument('--backend', default=DEPTH_BACKEND, choices=BACKENDS)
+    parser.add_argument('--onnx-path', default=MIDAS_ONNX_PATH)
+    parser.add_argument('--export-onnx', metavar='PATH')
+    parser.add_argument('--parity', action='store_true', help="compare the onnx backend against torch")
+    args = parser.parse_args()
+
+    if args.export_onnx:
+        export_onnx(args.export_onnx, args.model)
+        print(f"📦 Exported {args.model} to {args.export_onnx}")
+        sys.exit(0)
+    if not args.image:
+        parser.error("an image is required")
+
+    img_np = np.array(Image.open(args.image).convert("RGB"))
+    if args.parity:
+        result = check_parity(img_np, args.model, args.onnx_path)
+        print(f"⚖️ onnx vs torch: max diff {result['max_abs_diff']:.2e}, mean diff {result['mean_abs_diff']:.2e}, "
+              f"correlation {result['correlation']:.6f}")
+        sys.exit(0 if result['ok'] else 1)
+
+    model = get_depth_model(args.model, backend=args.backend, onnx_path=args.onnx_path)
+    print(f"🧠 Loaded {model.model_type} ({args.backend}) in {model.load_seconds:.2f}s")
+    depth = model.estimate(img_np)
+    print(f"🕳️ Depth {depth.shape} in {model.last_inference_seconds:.3f}s")
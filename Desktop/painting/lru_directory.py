@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+LRU Directory
+A directory of cache files under a disk budget, evicting the least recently used first.
+Shared by the depth-map cache and the backend's finished-render cache; each supplies its own keys and payload format.
+"""
+
+import os
+import tempfile
+
+
+class LRUDirectory:
+    # File extension of the entries; other files in the directory are left alone
+    suffix = ''
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, f"{key}{self.suffix}")
+
+    def touch(self, path):
+        """Mark an entry as just used; False if it no longer exists"""
+        try:
+            # mtime doubles as the last-used time for LRU eviction
+            os.utime(path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def store(self, key, write):
+        """Create key's entry by calling write(tmp_path), then publish it and evict down to the budget"""
+        # Written under a temp name and renamed, so concurrent readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        os.close(fd)
+        try:
+            write(tmp_path)
+            os.replace(tmp_path, self.path(key))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.evict()
+
+    def entries(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(self.suffix):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        return entries
+
+    def size_bytes(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        """Drop least recently used entries until the directory fits its budget"""
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                pass
+            total -= size
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+"""
+Painting Loading
+Upright, right-sized decoding of uploaded paintings with Pillow alone, shared by the style engine and the web backend
+"""
+
+from PIL import ExifTags, Image, ImageOps
+
+
+def oriented_size(img):
+    """Upright (width, height) of an opened image, read from its header without decoding pixels"""
+    width, height = img.size
+    # EXIF orientations 5-8 store the picture turned a quarter
+    if img.getexif().get(ExifTags.Base.Orientation) in (5, 6, 7, 8):
+        width, height = height, width
+    return width, height
+
+
+def open_painting(path, max_size):
+    """Decode path upright and no larger than needed for max_size; returns (image, upright source size).
+
+    JPEGs use the decoder's DCT scaling (draft mode) to decode at 1/2, 1/4 or 1/8 size
+    directly, so a 48 MP phone photo never exists in memory at full resolution. The
+    image can still exceed max_size by up to 2x; callers fit it to their exact size.
+    """
+    with Image.open(path) as source:
+        size = oriented_size(source)
+        scale = max_size / max(size)
+        if scale < 1:
+            # Target size in the stored orientation; draft() never decodes below it
+            source.draft('RGB', tuple(int(side * scale) + 1 for side in source.size))
+        image = ImageOps.exif_transpose(source).convert('RGB')
+    return image, size
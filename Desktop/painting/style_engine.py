@@ -0,0 +1,855 @@
+#!/usr/bin/env python3
+"""
+Style Engine
+Depth-driven animation styles, particle simulation and video encoding, shared by the CLI and the web backend
+"""
+
+import os
+import subprocess
+import tempfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from fractions import Fraction
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+from PIL import Image
+
+from depth_service import estimate_depth
+from painting_io import open_painting
+
+STYLES = ('ethereal', 'cyberpunk', 'impressionist', 'abstract', 'dreamlike', 'particle_powder')
+
+# Styles whose frames depend only on (image, depth_map, frame_index, total_frames)
+STATELESS_STYLES = ('ethereal', 'cyberpunk', 'impressionist', 'abstract', 'dreamlike')
+RENDER_WORKERS = int(os.environ.get('ANIMATION_WORKERS', os.cpu_count() or 1))
+# Seeds the precomputed particle simulation so powder renders are reproducible
+PARTICLE_SEED = int(os.environ.get('ANIMATION_SEED', '0'))
+# Memory per process for style frames held until a later frame in the same motion state reuses them
+FRAME_CACHE_MB = int(os.environ.get('ANIMATION_FRAME_CACHE_MB', '256'))
+
+def _sin_phase(turns):
+    # sin(turns * pi) repeats every 2 turns and is mirrored about turns = 1/2
+    return min(turns % 2, (1 - turns) % 2)
+
+# Exact motion state of a style at frame i of n, for styles whose motion is periodic
+# within the animation. Frames with equal keys have identical style output. The
+# others (ethereal, impressionist, abstract, dreamlike) sweep through phases that
+# never repeat within one animation, and particle_powder evolves continuously.
+STYLE_PHASE_KEYS = {
+    'cyberpunk': lambda i, n: _sin_phase(Fraction(4 * i, n)),
+}
+
+class ParticleSystem:
+    # Struct-of-arrays particle store: one fixed-capacity column per attribute plus a
+    # live mask, so spawning, physics, aging and culling are whole-array operations.
+    def __init__(self, width, height, max_particles=2000, rng=None):
+        self.width = width
+        self.height = height
+        self.max_particles = max_particles
+        self.rng = rng if rng is not None else np.random.default_rng()
+        
+        self.x = np.zeros(max_particles, dtype=np.float32)
+        self.y = np.zeros(max_particles, dtype=np.float32)
+        self.z = np.zeros(max_particles, dtype=np.float32)
+        self.vx = np.zeros(max_particles, dtype=np.float32)
+        self.vy = np.zeros(max_particles, dtype=np.float32)
+        self.vz = np.zeros(max_particles, dtype=np.float32)
+        self.size = np.zeros(max_particles, dtype=np.float32)
+        self.life = np.zeros(max_particles, dtype=np.float32)
+        self.birth = np.zeros(max_particles, dtype=np.float32)
+        self.rotation = np.zeros(max_particles, dtype=np.float32)
+        self.rotation_speed = np.zeros(max_particles, dtype=np.float32)
+        self.opacity = np.zeros(max_particles, dtype=np.float32)
+        self.current_size = np.zeros(max_particles, dtype=np.float32)
+        self.color = np.zeros((max_particles, 3), dtype=np.uint8)
+        self.alive = np.zeros(max_particles, dtype=bool)
+        self.rasterizer = SpriteRasterizer(width, height)
+        # Slots are reused lowest-first, so nothing live ever sits above this index
+        self.high_water = 0
+    
+    @property
+    def count(self):
+        return int(np.count_nonzero(self.alive[:self.high_water]))
+    
+    def live_indices(self):
+        return np.flatnonzero(self.alive[:self.high_water])
+    
+    def spawn(self, xs, ys, colors, depth_vals, frame_index):
+        free = np.flatnonzero(~self.alive)[:len(xs)]
+        n = len(free)
+        if n == 0:
+            return 0
+        
+        depth_vals = np.asarray(depth_vals, dtype=np.float32)[:n]
+        rng = self.rng
+        self.x[free] = np.asarray(xs)[:n]
+        self.y[free] = np.asarray(ys)[:n]
+        self.z[free] = depth_vals * 100
+        self.vx[free] = rng.uniform(-2, 2, n) * (1 + depth_vals)
+        self.vy[free] = rng.uniform(-3, -1, n) * (1 + depth_vals * 2)
+        self.vz[free] = rng.uniform(0.5, 2, n) * depth_vals
+        self.size[free] = rng.uniform(2, 6, n) * (1 + depth_vals)
+        self.life[free] = rng.uniform(60, 120, n)
+        self.birth[free] = frame_index
+        self.rotation[free] = rng.uniform(0, 360, n)
+        self.rotation_speed[free] = rng.uniform(-5, 5, n)
+        self.opacity[free] = 255
+        self.current_size[free] = self.size[free]
+        self.color[free] = np.asarray(colors)[:n]
+        self.alive[free] = True
+        self.high_water = max(self.high_water, int(free[-1]) + 1)
+        return n
+    
+    def add_particle(self, x, y, color, depth_val, frame_index):
+        self.spawn([x], [y], [color], [depth_val], frame_index)
+    
+    def update_particles(self, frame_index):
+        hw = self.high_water
+        live = self.alive[:hw]
+        age = frame_index - self.birth[:hw]
+        live &= age < self.life[:hw]
+        
+        # Integrate every slot below the high-water mark; dead slots are masked out by alive
+        self.x[:hw] += self.vx[:hw]
+        self.y[:hw] += self.vy[:hw]
+        self.z[:hw] += self.vz[:hw]
+        self.vy[:hw] += 0.1
+        self.vx[:hw] *= 0.995
+        self.vy[:hw] *= 0.995
+        self.vz[:hw] *= 0.99
+        self.rotation[:hw] += self.rotation_speed[:hw]
+        self.opacity[:hw] = np.floor(255 * (1 - age / self.life[:hw]))
+        self.current_size[:hw] = self.size[:hw] * (1 + self.z[:hw] / 200)
+        
+        live_slots = np.flatnonzero(live)
+        self.high_water = int(live_slots[-1]) + 1 if live_slots.size else 0
+    
+    def render_particles(self, image):
+        live = self.live_indices()
+        frame = self.rasterizer.draw(np.asarray(image), self.x[live], self.y[live], self.z[live],
+                                     self.current_size[live], self.color[live], self.opacity[live])
+        return Image.fromarray(frame)
+
+class SpriteRasterizer:
+    # Batched particle splatting. Particles are grouped by (size, blur) bucket, each
+    # bucket stamps a cached sprite kernel for all of its particles at once, and the
+    # result is accumulated as premultiplied colour plus log-transmittance per pixel.
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.sprites = {}
+    
+    def sprite(self, size, blur_size):
+        key = (size, blur_size)
+        if key not in self.sprites:
+            radius = size // 2
+            span = np.arange(-radius, radius + 1)
+            disc = span[:, None]**2 + span[None, :]**2 <= radius * radius + radius
+            copies = max(1, blur_size)
+            first = -(blur_size // 2) if blur_size else 0
+            # Coverage count: how many of the diagonal copies land on each kernel pixel
+            counts = np.zeros((disc.shape[0] + copies - 1, disc.shape[1] + copies - 1), dtype=np.int32)
+            for i in range(copies):
+                counts[i:i + disc.shape[0], i:i + disc.shape[1]] += disc
+            dy, dx = np.nonzero(counts)
+            self.sprites[key] = (dy + first - radius, dx + first - radius, counts[dy, dx])
+        return self.sprites[key]
+    
+    def draw(self, img_array, xs, ys, zs, current_sizes, colors, opacities):
+        on_canvas = (xs >= 0) & (xs < self.width) & (ys >= 0) & (ys < self.height)
+        xs, ys, zs = xs[on_canvas], ys[on_canvas], zs[on_canvas]
+        colors, opacities = colors[on_canvas], opacities[on_canvas]
+        
+        alpha = np.clip(opacities, 0, 255).astype(np.int32)
+        size = np.maximum(1, current_sizes[on_canvas].astype(np.int32))
+        # Far particles are smeared into blur_size fainter copies along the diagonal
+        blur_size = np.where(zs > 50, np.maximum(1, (zs / 30).astype(np.int32)), 0)
+        alpha = np.where(blur_size > 0, alpha // (blur_size + 1), alpha)
+        return self.composite(img_array, xs.astype(np.int32), ys.astype(np.int32), size, blur_size, colors, alpha, zs)
+    
+    def composite(self, img_array, xs, ys, sizes, blur_sizes, colors, alphas, depths):
+        h, w = self.height, self.width
+        visible = alphas > 0
+        xs, ys, sizes, blur_sizes = xs[visible], ys[visible], sizes[visible], blur_sizes[visible]
+        colors, alphas, depths = colors[visible], alphas[visible], depths[visible]
+        if len(xs) == 0:
+            return np.array(img_array, dtype=np.uint8)
+        
+        pixel_ids, log_transmit, coverage = [], [], []
+        keys = sizes.astype(np.int64) * 1024 + blur_sizes
+        buckets, bucket_of = np.unique(keys, return_inverse=True)
+        for bucket, key in enumerate(buckets):
+            members = np.flatnonzero(bucket_of == bucket)
+            dy, dx, counts = self.sprite(int(key // 1024), int(key % 1024))
+            
+            py = ys[members, None] + dy[None, :]
+            px = xs[members, None] + dx[None, :]
+            inside = (px >= 0) & (px < w) & (py >= 0) & (py < h)
+            # Stacking k copies of alpha a leaves (1 - a)^k of the background visible
+            per_copy = np.log1p(-np.minimum(alphas[members] / 255.0, 0.999))
+            log_t = np.broadcast_to(counts[None, :] * per_copy[:, None], inside.shape)[inside]
+            
+            pixel_ids.append((py * w + px)[inside])
+            log_transmit.append(log_t)
+            coverage.append(np.repeat(members, inside.sum(axis=1)))
+        
+        pixel_ids = np.concatenate(pixel_ids)
+        log_transmit = np.concatenate(log_transmit)
+        owners = np.concatenate(coverage)
+        # Near particles were painted last (on top) by the old z-sorted renderer, so they
+        # dominate the blended colour where several particles overlap
+        weight = -np.expm1(log_transmit) * np.exp(-depths[owners] / 25.0)
+        
+        transmit = np.exp(np.bincount(pixel_ids, weights=log_transmit, minlength=h * w)).reshape(h, w, 1)
+        weight_sum = np.bincount(pixel_ids, weights=weight, minlength=h * w)
+        premultiplied = np.stack([np.bincount(pixel_ids, weights=weight * colors[owners, ch], minlength=h * w)
+                                  for ch in range(3)], axis=-1)
+        particle_color = premultiplied / np.maximum(weight_sum, 1e-12)[:, None]
+        
+        frame = img_array[:, :, :3] * transmit + particle_color.reshape(h, w, 3) * (1 - transmit)
+        return np.clip(frame + 0.5, 0, 255).astype(np.uint8)
+
+class ParticleTimeline:
+    # Seeded, precomputed version of the ParticleSystem simulation. Every particle's
+    # spawn frame and launch parameters are drawn up front in one pass, and the
+    # drag/gravity integration of update_particles has a closed form, so the state
+    # at any frame comes straight from the frame index. Renders are reproducible
+    # and frames can be produced in any order, including across processes.
+    DRAG_XY = 0.995
+    DRAG_Z = 0.99
+    GRAVITY = 0.1
+    
+    def __init__(self, img_array, depth_map, total_frames, seed=0, max_particles=2000):
+        h, w = depth_map.shape
+        self.width, self.height = w, h
+        self.rasterizer = SpriteRasterizer(w, h)
+        rng = np.random.default_rng(seed)
+        
+        frames = np.arange(total_frames)
+        spawn_rates = np.maximum(1, (30 * (1 + np.sin(frames / total_frames * 4 * np.pi))).astype(np.intp))
+        birth = np.repeat(frames, spawn_rates)
+        n = len(birth)
+        xs = rng.integers(0, w, n)
+        ys = rng.integers(0, h, n)
+        depth_vals = depth_map[ys, xs].astype(np.float32)
+        keep = rng.random(n) < depth_vals * 0.8
+        colors = np.asarray(img_array)[ys, xs, :3].astype(int) + rng.integers(-20, 21, (n, 3))
+        life = rng.uniform(60, 120, n)
+        
+        keep[keep] = self._admit(birth[keep], life[keep], total_frames, max_particles)
+        n = int(np.count_nonzero(keep))
+        depth_vals = depth_vals[keep]
+        self.birth = birth[keep]
+        self.life = life[keep].astype(np.float32)
+        self.x0 = xs[keep].astype(np.float32)
+        self.y0 = ys[keep].astype(np.float32)
+        self.z0 = depth_vals * 100
+        self.color = np.clip(colors[keep], 0, 255).astype(np.uint8)
+        self.vx0 = (rng.uniform(-2, 2, n) * (1 + depth_vals)).astype(np.float32)
+        self.vy0 = (rng.uniform(-3, -1, n) * (1 + depth_vals * 2)).astype(np.float32)
+        self.vz0 = (rng.uniform(0.5, 2, n) * depth_vals).astype(np.float32)
+        self.size = (rng.uniform(2, 6, n) * (1 + depth_vals)).astype(np.float32)
+        self.rotation0 = rng.uniform(0, 360, n).astype(np.float32)
+        self.rotation_speed = rng.uniform(-5, 5, n).astype(np.float32)
+        self.max_life = int(np.ceil(self.life.max())) if n else 0
+    
+    @staticmethod
+    def _admit(birth, life, total_frames, max_particles):
+        # Replays ParticleSystem's fixed capacity: a spawn is admitted only while a
+        # slot is free, and a slot frees up on the first frame where age >= life.
+        admitted = np.zeros(len(birth), dtype=bool)
+        death_frame = birth + np.ceil(life).astype(np.intp)
+        deaths = np.zeros(total_frames + 122, dtype=np.intp)
+        starts = np.searchsorted(birth, np.arange(total_frames + 1))
+        alive = 0
+        for frame_index in range(total_frames):
+            start, stop = starts[frame_index], starts[frame_index + 1]
+            take = min(stop - start, max(0, max_particles - alive))
+            admitted[start:start + take] = True
+            np.add.at(deaths, death_frame[start:start + take], 1)
+            alive += take - deaths[frame_index]
+        return admitted
+    
+    def live_at(self, frame_index):
+        # Births are sorted, so only the window of possible lifetimes needs checking
+        start, stop = np.searchsorted(self.birth, [frame_index - self.max_life, frame_index], side='right')
+        age = frame_index - self.birth[start:stop]
+        return start + np.flatnonzero(age < self.life[start:stop])
+    
+    def count_at(self, frame_index):
+        return len(self.live_at(frame_index))
+    
+    def state_at(self, frame_index):
+        live = self.live_at(frame_index)
+        age = (frame_index - self.birth[live]).astype(np.float32)
+        # A particle has been integrated once per frame from its birth frame onwards
+        steps = age + 1
+        xy_decay = (1 - self.DRAG_XY ** steps) / (1 - self.DRAG_XY)
+        z_decay = (1 - self.DRAG_Z ** steps) / (1 - self.DRAG_Z)
+        terminal_vy = self.GRAVITY * self.DRAG_XY / (1 - self.DRAG_XY)
+        
+        z = self.z0[live] + self.vz0[live] * z_decay
+        return {
+            'x': self.x0[live] + self.vx0[live] * xy_decay,
+            'y': self.y0[live] + steps * terminal_vy + (self.vy0[live] - terminal_vy) * xy_decay,
+            'z': z,
+            'rotation': self.rotation0[live] + self.rotation_speed[live] * steps,
+            'opacity': np.floor(255 * (1 - age / self.life[live])),
+            'current_size': self.size[live] * (1 + z / 200),
+            'color': self.color[live],
+        }
+    
+    def render(self, img_array, frame_index):
+        state = self.state_at(frame_index)
+        return self.rasterizer.draw(img_array, state['x'], state['y'], state['z'],
+                                    state['current_size'], state['color'], state['opacity'])
+
+class DisplacementRemap:
+    # Shared remap engine: styles build a per-pixel displacement field as whole
+    # arrays and every output pixel is fetched with a single fancy-index gather.
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.rows = np.arange(height, dtype=np.float64)[:, None]
+        self.cols = np.arange(width, dtype=np.float64)[None, :]
+        self.row_index = np.arange(height, dtype=np.intp)[:, None]
+        self.col_index = np.arange(width, dtype=np.intp)[None, :]
+    
+    def gather(self, img_array, offset_x, offset_y):
+        # Offsets truncate toward zero like int() and are clamped to the canvas edge
+        src_x = self.col_index + np.asarray(offset_x).astype(np.intp)
+        src_y = self.row_index + np.asarray(offset_y).astype(np.intp)
+        return self.sample(img_array, src_x, src_y)
+    
+    def sample(self, img_array, src_x, src_y):
+        src_x = np.asarray(src_x).astype(np.intp, copy=False)
+        src_y = np.asarray(src_y).astype(np.intp, copy=False)
+        np.clip(src_x, 0, self.width - 1, out=src_x)
+        np.clip(src_y, 0, self.height - 1, out=src_y)
+        return img_array[src_y, src_x]
+    
+    def expand_blocks(self, block_values, block_size):
+        # Repeat one value per block back up to full canvas resolution
+        expanded = np.repeat(np.repeat(block_values, block_size, axis=0), block_size, axis=1)
+        return expanded[:self.height, :self.width]
+
+class PolarIndex:
+    # Per-image polar coordinates around the canvas center. Angle, radius and the
+    # depth-scaled angle offset never change between frames, so they are built once.
+    def __init__(self, width, height, depth_map):
+        self.center_x, self.center_y = width // 2, height // 2
+        dy = np.arange(height, dtype=np.float64)[:, None] - self.center_y
+        dx = np.arange(width, dtype=np.float64)[None, :] - self.center_x
+        self.angle = np.arctan2(dy, dx)
+        self.radius = np.sqrt(dx**2 + dy**2)
+        self.angle_offset = depth_map * np.pi * 0.5
+    
+    def rotated(self, rotation):
+        new_angle = (self.angle + rotation) + self.angle_offset
+        src_x = self.center_x + np.cos(new_angle) * self.radius
+        src_y = self.center_y + np.sin(new_angle) * self.radius
+        return src_x, src_y
+
+class PowderCanvas:
+    # Per-image tables for the canvas under the powder particles: the flat indices and
+    # depths of the pixels that fade (depth > 0.6) and the per-row wave phase.
+    def __init__(self, width, height, depth_map, wave_strength=2):
+        self.width = width
+        self.height = height
+        self.wave_strength = wave_strength
+        flat_depth = np.asarray(depth_map).reshape(-1)
+        self.fade_index = np.flatnonzero(flat_depth > 0.6)
+        self.fade_depth = flat_depth[self.fade_index]
+        self.blend_factor = (self.fade_depth * 0.2)[:, None]
+        self.row_phase = np.arange(height, dtype=np.float64) * 0.01
+        self.row_index = np.arange(height, dtype=np.intp)[:, None]
+        self.col_index = np.arange(width, dtype=np.intp)[None, :]
+    
+    def apply(self, img_array, extraction_intensity, wave_phase):
+        pixels = img_array.reshape(-1, img_array.shape[2])
+        faded = pixels[self.fade_index] * (1 - self.fade_depth * extraction_intensity * 0.4)[:, None]
+        gray = faded.mean(axis=1, keepdims=True)
+        pixels[self.fade_index] = faded * (1 - self.blend_factor) + gray * self.blend_factor
+        
+        # Each row is rolled sideways by its own wave offset, done as one gather
+        wave_offset = (self.wave_strength * np.sin(wave_phase + self.row_phase)).astype(np.intp)
+        src_x = (self.col_index - wave_offset[:, None]) % self.width
+        return img_array[self.row_index, src_x]
+
+class ArtisticStyleProcessor:
+    def __init__(self, width=1024, height=1024, depth_map=None, seed=None):
+        self.styles = {
+            'ethereal': self.ethereal_style,
+            'cyberpunk': self.cyberpunk_style,
+            'impressionist': self.impressionist_style,
+            'abstract': self.abstract_style,
+            'dreamlike': self.dreamlike_style,
+            'particle_powder': self.particle_powder_style
+        }
+        self.particle_system = ParticleSystem(width, height)
+        # With a seed, particle_powder evaluates a precomputed ParticleTimeline instead
+        # of stepping particle_system, which makes its frames independent of each other
+        self.seed = seed
+        self.particle_timeline = None
+        self.remap = DisplacementRemap(width, height)
+        self.polar = PolarIndex(width, height, depth_map) if depth_map is not None else None
+        self.powder_canvas = PowderCanvas(width, height, depth_map) if depth_map is not None else None
+        self.color_cache = {}
+        self.frame_cache = {}
+        self.frame_cache_bytes = 0
+        self.frame_last_use = None
+        self.reused_frames = 0
+        self.post = FramePostProcessor(width, height)
+    
+    def style_frame(self, style, image, depth_map, frame_index, total_frames):
+        # Renders the style, or returns the output of an earlier frame in the same motion state.
+        # A frame is kept only while a later frame still needs it, within FRAME_CACHE_MB.
+        phase_key = STYLE_PHASE_KEYS.get(style)
+        if phase_key is None or FRAME_CACHE_MB <= 0:
+            return self.styles[style](image, depth_map, frame_index, total_frames)
+        if self.frame_last_use is None:
+            self.frame_last_use = {phase_key(i, total_frames): i for i in range(total_frames)}
+        key = phase_key(frame_index, total_frames)
+        frame = self.frame_cache.get(key)
+        if frame is not None:
+            self.reused_frames += 1
+            if self.frame_last_use[key] <= frame_index:
+                del self.frame_cache[key]
+                self.frame_cache_bytes -= frame.nbytes
+            return frame
+        frame = self.styles[style](image, depth_map, frame_index, total_frames)
+        if (self.frame_last_use[key] > frame_index
+                and self.frame_cache_bytes + frame.nbytes <= FRAME_CACHE_MB * 1024 * 1024):
+            self.frame_cache[key] = frame
+            self.frame_cache_bytes += frame.nbytes
+        return frame
+    
+    def prepare_particles(self, image, depth_map, total_frames):
+        self.particle_timeline = ParticleTimeline(np.asarray(image), depth_map, total_frames, seed=self.seed,
+                                                  max_particles=self.particle_system.max_particles)
+    
+    def particle_count(self, frame_index):
+        if self.particle_timeline is not None:
+            return self.particle_timeline.count_at(frame_index)
+        return self.particle_system.count
+    
+    def particle_powder_style(self, image, depth_map, frame_index, total_frames):
+        img_array = np.array(image).astype(np.float32)
+        h, w, c = img_array.shape
+        time_factor = frame_index / total_frames
+        
+        if self.seed is not None and self.particle_timeline is None:
+            self.prepare_particles(image, depth_map, total_frames)
+        
+        if self.particle_timeline is None:
+            particle_spawn_rate = max(1, int(30 * (1 + np.sin(time_factor * 4 * np.pi))))
+            
+            rng = self.particle_system.rng
+            xs = rng.integers(0, w, particle_spawn_rate)
+            ys = rng.integers(0, h, particle_spawn_rate)
+            depth_vals = depth_map[ys, xs]
+            keep = rng.random(particle_spawn_rate) < depth_vals * 0.8
+            xs, ys, depth_vals = xs[keep], ys[keep], depth_vals[keep]
+            
+            colors = img_array[ys, xs].astype(int) + rng.integers(-20, 21, (len(xs), 3))
+            colors = np.clip(colors, 0, 255).astype(np.uint8)
+            self.particle_system.spawn(xs, ys, colors, depth_vals, frame_index)
+            
+            self.particle_system.update_particles(frame_index)
+        
+        if self.powder_canvas is None:
+            self.powder_canvas = PowderCanvas(w, h, depth_map)
+        extraction_intensity = 0.3 + 0.2 * np.sin(time_factor * 2 * np.pi)
+        enhanced_img = self.powder_canvas.apply(img_array, extraction_intensity, time_factor * 2 * np.pi)
+        canvas = np.clip(enhanced_img, 0, 255).astype(np.uint8)
+        
+        if self.particle_timeline is not None:
+            return self.particle_timeline.render(canvas, frame_index)
+        final_img = self.particle_system.render_particles(Image.fromarray(canvas))
+        return np.array(final_img)
+    
+    def ethereal_style(self, image, depth_map, frame_index, total_frames):
+        img_array = np.array(image).astype(np.float32)
+        time_factor = frame_index / total_frames
+        grid = self.remap
+        
+        wave_x = np.sin(time_factor * 2 * np.pi + grid.rows * 0.02 + grid.cols * 0.01) * depth_map * 8
+        wave_y = np.cos(time_factor * 1.5 * np.pi + grid.rows * 0.015 + grid.cols * 0.02) * depth_map * 5
+        enhanced_img = grid.gather(img_array, wave_x, wave_y)
+        
+        brightness = np.mean(enhanced_img, axis=2)
+        glow_mask = brightness > 180
+        enhanced_img[glow_mask] *= 1.3
+        enhanced_img[:, :, 0] *= 1.1
+        enhanced_img[:, :, 2] *= 0.95
+        return np.clip(enhanced_img, 0, 255).astype(np.uint8)
+    
+    def cyberpunk_style(self, image, depth_map, frame_index, total_frames):
+        img_array = np.array(image).astype(np.float32)
+        time_factor = frame_index / total_frames
+        grid = self.remap
+        
+        # Each 2x2 block shifts horizontally by the depth at its top-left pixel
+        block_depth = depth_map[::2, ::2]
+        displacement = (block_depth * 12 * np.sin(time_factor * 4 * np.pi)).astype(np.intp)
+        block_x = np.clip(grid.col_index[:, ::2] + displacement, 0, grid.width - 1)
+        src_x = grid.expand_blocks(block_x, 2) + grid.col_index % 2
+        enhanced_img = grid.sample(img_array, src_x, grid.row_index)
+        
+        enhanced_img[:, :, 0] *= 1.2
+        enhanced_img[:, :, 1] *= 0.8
+        enhanced_img[:, :, 2] *= 1.4
+        return np.clip(enhanced_img, 0, 255).astype(np.uint8)
+    
+    def impressionist_style(self, image, depth_map, frame_index, total_frames):
+        img_array = np.array(image).astype(np.float32)
+        time_factor = frame_index / total_frames
+        grid = self.remap
+        
+        # One brush stroke per 4x4 block, driven by the depth at its top-left pixel
+        block_depth = depth_map[::4, ::4]
+        stroke_length = (block_depth * 6 + 2).astype(np.intp)
+        angle = time_factor * np.pi + block_depth * np.pi
+        dx = (np.cos(angle) * stroke_length).astype(np.intp)
+        dy = (np.sin(angle) * stroke_length).astype(np.intp)
+        
+        block_x = np.clip(grid.col_index[:, ::4] + dx, 0, grid.width - 1)
+        block_y = np.clip(grid.row_index[::4] + dy, 0, grid.height - 1)
+        src_x = grid.expand_blocks(block_x, 4) + grid.col_index % 4
+        src_y = grid.expand_blocks(block_y, 4) + grid.row_index % 4
+        enhanced_img = grid.sample(img_array, src_x, src_y)
+        
+        enhanced_img *= 0.9
+        enhanced_img[:, :, 1] *= 1.1
+        return np.clip(enhanced_img, 0, 255).astype(np.uint8)
+    
+    def abstract_style(self, image, depth_map, frame_index, total_frames):
+        img_array = np.array(image).astype(np.float32)
+        h, w, c = img_array.shape
+        time_factor = frame_index / total_frames
+        
+        if self.polar is None:
+            self.polar = PolarIndex(w, h, depth_map)
+        src_x, src_y = self.polar.rotated(time_factor * np.pi)
+        enhanced_img = self.remap.sample(img_array, src_x, src_y)
+        
+        return np.clip(enhanced_img, 0, 255).astype(np.uint8)
+    
+    def dreamlike_style(self, image, depth_map, frame_index, total_frames):
+        img_array = np.array(image).astype(np.float32)
+        time_factor = frame_index / total_frames
+        grid = self.remap
+        
+        # wave1 only varies by row and wave2 only by column, so they stay 1-D until scaled by depth
+        wave1 = np.sin(time_factor * 2 * np.pi + grid.rows * 0.03) * depth_map * 10
+        wave2 = np.cos(time_factor * 1.5 * np.pi + grid.cols * 0.025) * depth_map * 8
+        wave3 = np.sin(time_factor * 3 * np.pi + (grid.cols + grid.rows) * 0.01) * depth_map * 6
+        
+        enhanced_img = grid.gather(img_array, wave1 + wave2, wave2 + wave3)
+        
+        enhanced_img[:, :, 0] *= 1.05
+        enhanced_img[:, :, 1] *= 1.1
+        enhanced_img[:, :, 2] *= 1.08
+        return np.clip(enhanced_img, 0, 255).astype(np.uint8)
+
+class FramePostProcessor:
+    # Same result as ImageEnhance.Color followed by ImageEnhance.Contrast, with less work.
+    # Contrast only needs the mean luma, read from the luma histogram, and then becomes a
+    # 256-entry table applied in a single point() pass. That replaces building a
+    # constant gray image, converting it to RGB and blending with it.
+    LEVELS = np.arange(256, dtype=np.float32)
+    
+    def __init__(self, width, height):
+        self.pixels = width * height
+    
+    def apply(self, frame, saturation, contrast):
+        frame_img = Image.fromarray(frame)
+        saturated = Image.blend(frame_img.convert("L").convert("RGB"), frame_img, saturation)
+        
+        histogram = np.asarray(saturated.convert("L").histogram(), dtype=np.float64)
+        mean = int(float(histogram @ self.LEVELS) / self.pixels + 0.5)
+        # Pillow blends in float32 and truncates, so the table does the same
+        table = np.float32(mean) + np.float32(contrast) * (self.LEVELS - np.float32(mean))
+        table = np.clip(table, 0, 255).astype(np.uint8).tolist()
+        return np.asarray(saturated.point(table * 3))
+
+class FrameEncoder:
+    # Streams raw RGB frames straight into an ffmpeg stdin pipe as they are rendered,
+    # so only the frame being written is held in memory regardless of duration.
+    # The video is written under a temporary name and moved to output_path only once
+    # ffmpeg succeeds, so an aborted render never leaves a truncated file behind.
+    def __init__(self, output_path, width, height, fps=30, bitrate="8000k", crf="18", preset="slow"):
+        self.width = width
+        self.height = height
+        self.frames_written = 0
+        self.output_path = output_path
+        root, ext = os.path.splitext(output_path)
+        self.partial_path = f"{root}.partial{ext or '.mp4'}"
+        try:
+            import imageio_ffmpeg
+            ffmpeg_exe = imageio_ffmpeg.get_ffmpeg_exe()
+        except ImportError:
+            ffmpeg_exe = "ffmpeg"
+        
+        cmd = [ffmpeg_exe, "-y", "-loglevel", "error",
+               "-f", "rawvideo", "-vcodec", "rawvideo", "-pix_fmt", "rgb24",
+               "-s", f"{width}x{height}", "-r", str(fps), "-i", "-",
+               "-an", "-vcodec", "libx264", "-preset", preset, "-b:v", bitrate, "-crf", str(crf)]
+        # Browsers only play 4:2:0 H.264, which needs even dimensions: odd canvases lose their last row or column
+        if width % 2 or height % 2:
+            cmd += ["-vf", f"crop={width - width % 2}:{height - height % 2}:0:0"]
+        cmd += ["-pix_fmt", "yuv420p", self.partial_path]
+        
+        self.log = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=self.log)
+    
+    def write(self, frame):
+        frame = np.asarray(frame, dtype=np.uint8)
+        if frame.shape != (self.height, self.width, 3):
+            raise ValueError(f"Frame shape {frame.shape} does not match encoder size {self.width}x{self.height}")
+        try:
+            self.process.stdin.write(np.ascontiguousarray(frame).tobytes())
+        except BrokenPipeError:
+            self.close()
+            raise
+        self.frames_written += 1
+    
+    def close(self):
+        if self.process.stdin and not self.process.stdin.closed:
+            try:
+                self.process.stdin.close()
+            except BrokenPipeError:
+                pass
+        returncode = self.process.wait()
+        if returncode != 0:
+            self.log.seek(0)
+            message = self.log.read().decode(errors="replace").strip()
+            self.log.close()
+            self._discard()
+            raise RuntimeError(f"ffmpeg exited with status {returncode}: {message}")
+        self.log.close()
+        os.replace(self.partial_path, self.output_path)
+    
+    def _discard(self):
+        try:
+            os.remove(self.partial_path)
+        except FileNotFoundError:
+            pass
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.process.kill()
+            self.process.wait()
+            self.log.close()
+            self._discard()
+        return False
+
+def render_frame(processor, style, image, depth_map, frame_index, total_frames):
+    artistic_frame = processor.style_frame(style, image, depth_map, frame_index, total_frames)
+    return finish_frame(processor, artistic_frame, frame_index, total_frames)
+
+def finish_frame(processor, artistic_frame, frame_index, total_frames):
+    time_factor = frame_index / total_frames
+    saturation = 1.0 + 0.4 * np.sin(time_factor * 2 * np.pi)
+    contrast = 1.0 + 0.3 * np.cos(time_factor * 1.5 * np.pi)
+    return processor.post.apply(artistic_frame, saturation, contrast)
+
+# Per-process state for parallel rendering, set up once by _init_frame_worker
+_frame_worker = {}
+
+def _share_array(array):
+    shm = SharedMemory(create=True, size=array.nbytes)
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[:] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+def _attach_array(spec):
+    name, shape, dtype = spec
+    shm = SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+def _init_frame_worker(style, image_spec, depth_spec, total_frames, seed):
+    image_shm, image = _attach_array(image_spec)
+    depth_shm, depth_map = _attach_array(depth_spec)
+    h, w, _ = image.shape
+    processor = ArtisticStyleProcessor(w, h, depth_map, seed=seed)
+    if style == 'particle_powder':
+        processor.prepare_particles(image, depth_map, total_frames)
+    _frame_worker.update(
+        style=style, image=image, depth_map=depth_map, total_frames=total_frames, processor=processor,
+        # Keep the mappings referenced for the lifetime of the worker
+        shm=(image_shm, depth_shm))
+
+def _render_frame_range(start, stop, style_frames=None, keep=()):
+    # style_frames maps phase keys to style output the parent already has; keys in keep
+    # are rendered here and sent back, for the parent to hand to later ranges
+    state = _frame_worker
+    processor, style, total_frames = state['processor'], state['style'], state['total_frames']
+    phase_key = STYLE_PHASE_KEYS.get(style) if style_frames is not None else None
+    if phase_key is None:
+        return [render_frame(processor, style, state['image'], state['depth_map'], i, total_frames)
+                for i in range(start, stop)], {}
+    frames, kept = [], {}
+    for i in range(start, stop):
+        key = phase_key(i, total_frames)
+        artistic_frame = style_frames.get(key)
+        if artistic_frame is None:
+            artistic_frame = processor.styles[style](state['image'], state['depth_map'], i, total_frames)
+            style_frames[key] = artistic_frame
+            if key in keep:
+                kept[key] = artistic_frame
+        frames.append(finish_frame(processor, artistic_frame, i, total_frames))
+    return frames, kept
+
+def render_frames_parallel(style, img_np, depth_map, total_frames, workers, chunk_size=4, seed=None):
+    # Source image and depth map are shared with the workers instead of pickled per
+    # task. Frame ranges render concurrently and are yielded back in frame order,
+    # with at most two ranges per worker in flight so memory stays bounded.
+    # For styles with STYLE_PHASE_KEYS, each motion phase is styled once across the
+    # pool: the parent keeps the style output (within FRAME_CACHE_MB) and sends it with
+    # later ranges in the same phase, which then only post-process it.
+    phase_key = STYLE_PHASE_KEYS.get(style) if FRAME_CACHE_MB > 0 else None
+    ranges = [(start, min(start + chunk_size, total_frames)) for start in range(0, total_frames, chunk_size)]
+    needs = [set() for _ in ranges]
+    keeps = [set() for _ in ranges]
+    # Ranges not yet submitted that need each phase's style output
+    waiting = {}
+    if phase_key is not None:
+        keys = [phase_key(i, total_frames) for i in range(total_frames)]
+        first_use, last_use = {}, {}
+        for i, key in enumerate(keys):
+            first_use.setdefault(key, i)
+            last_use[key] = i
+        for r, (start, stop) in enumerate(ranges):
+            for i in range(start, stop):
+                if first_use[keys[i]] < start:
+                    if keys[i] not in needs[r]:
+                        waiting[keys[i]] = waiting.get(keys[i], 0) + 1
+                    needs[r].add(keys[i])
+                elif first_use[keys[i]] == i and last_use[keys[i]] >= stop:
+                    keeps[r].add(keys[i])
+    
+    image_shm, image_spec = _share_array(np.ascontiguousarray(img_np))
+    depth_shm, depth_spec = _share_array(np.ascontiguousarray(depth_map))
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_frame_worker,
+                                 initargs=(style, image_spec, depth_spec, total_frames, seed)) as pool:
+            style_frames, style_bytes = {}, 0
+            in_flight, finished, submitted = {}, {}, set()
+            done = set()
+            next_yield = 0
+            while next_yield < len(ranges):
+                # Ranges run at most a few batches ahead of the encoder; one still waiting for a
+                # phase that an unfinished range will style is passed over until that range is back
+                for r in range(next_yield, min(len(ranges), next_yield + workers * 4)):
+                    if len(in_flight) >= workers * 2:
+                        break
+                    if r in submitted or any(key not in style_frames and first_use[key] // chunk_size not in done
+                                             for key in needs[r]):
+                        continue
+                    provided = {key: style_frames[key] for key in needs[r] if key in style_frames}
+                    future = pool.submit(_render_frame_range, *ranges[r],
+                                         provided if phase_key is not None else None, keeps[r])
+                    in_flight[future] = r
+                    submitted.add(r)
+                    for key in needs[r]:
+                        waiting[key] -= 1
+                        if not waiting[key] and key in style_frames:
+                            style_bytes -= style_frames.pop(key).nbytes
+                completed, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in completed:
+                    r = in_flight.pop(future)
+                    finished[r], kept = future.result()
+                    done.add(r)
+                    for key, frame in kept.items():
+                        if waiting.get(key) and style_bytes + frame.nbytes <= FRAME_CACHE_MB * 1024 * 1024:
+                            style_frames[key] = frame
+                            style_bytes += frame.nbytes
+                while next_yield in finished:
+                    yield from finished.pop(next_yield)
+                    next_yield += 1
+    finally:
+        for shm in (image_shm, depth_shm):
+            shm.close()
+            shm.unlink()
+
+def _report(progress, stage, **fields):
+    if progress is not None:
+        progress(dict(stage=stage, **fields))
+
+def _fit(image, max_size):
+    image = image.copy()
+    if max(image.size) > max_size:
+        image.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
+    return image
+
+def prepare_depth(image_path, max_size=1200, depth_backend=None, tiled_depth=None):
+    # Estimates, or loads from the depth cache, the map render() will use for this image at max_size
+    img = _fit(open_painting(image_path, max_size)[0], max_size)
+    _, depth_timings = estimate_depth(np.array(img), backend=depth_backend, tiled=tiled_depth)
+    return depth_timings
+
+def render(image_path, output_path, style='particle_powder', num_frames=300, bitrate="8000k", crf="18",
+           max_size=1200, progress=None, fps=30, preset="slow", depth_size=None, workers=None, seed=None,
+           depth_backend=None, tiled_depth=None):
+    # progress, if given, is called with a dict for each stage and rendered frame.
+    # depth_size estimates depth on the image fitted to that size and resamples it to the
+    # frame size, so a small preview shares the depth-cache entry of the full render.
+    # depth_backend picks the depth_service backend ('torch' or 'onnx') for this render.
+    # tiled_depth forces tiled full-resolution depth on or off; by default large images are tiled.
+    if style not in STYLES:
+        raise ValueError(f"Unknown style: {style}")
+    workers = RENDER_WORKERS if workers is None else workers
+    seed = PARTICLE_SEED if seed is None else seed
+    
+    _report(progress, 'loading')
+    source, source_size = open_painting(image_path, max(max_size, depth_size or 0))
+    img = _fit(source, max_size)
+    img_np = np.array(img)
+    depth_img = _fit(source, depth_size) if depth_size and depth_size != max_size else img
+    
+    print("🕳️ Analyzing depth...")
+    _report(progress, 'depth')
+    depth_norm, depth_timings = estimate_depth(np.array(depth_img), backend=depth_backend, tiled=tiled_depth)
+    if depth_img.size != img.size:
+        depth_norm = np.asarray(Image.fromarray(np.asarray(depth_norm, dtype=np.float32))
+                                .resize(img.size, Image.Resampling.BILINEAR))
+    if depth_timings['cache'] == 'hit':
+        print("   Depth map loaded from cache")
+    else:
+        print(f"   Model ready in {depth_timings['load_seconds']:.2f}s, "
+              f"{'tiled ' if depth_timings['tiled'] else ''}inference took {depth_timings['inference_seconds']:.2f}s")
+    
+    h, w, _ = img_np.shape
+    
+    processor = ArtisticStyleProcessor(w, h, depth_norm, seed=seed)
+    if style == 'particle_powder':
+        _report(progress, 'particles')
+        processor.prepare_particles(img_np, depth_norm, num_frames)
+    
+    print(f"🎬 Generating and encoding {num_frames} frames...")
+    
+    stateless = style in STATELESS_STYLES or processor.particle_timeline is not None
+    if stateless and workers > 1:
+        print(f"⚡ Rendering across {workers} worker processes")
+        frames = render_frames_parallel(style, img_np, depth_norm, num_frames, workers, seed=seed)
+    else:
+        frames = (render_frame(processor, style, img, depth_norm, i, num_frames) for i in range(num_frames))
+    
+    with FrameEncoder(output_path, w, h, fps=fps, bitrate=bitrate, crf=crf, preset=preset) as encoder:
+        for i, frame in enumerate(frames):
+            particle_count = processor.particle_count(i)
+            if i % 20 == 0:
+                print(f"✨ Frame {i+1}/{num_frames} - Particles: {particle_count}")
+            encoder.write(frame)
+            _report(progress, 'frames', current=i + 1, total=num_frames, particles=particle_count)
+        _report(progress, 'encoding')
+    
+    # The encoder drops an odd last row or column
+    return {'style': style, 'frames': num_frames, 'fps': fps, 'width': w - w % 2, 'height': h - h % 2,
+            'depth': depth_timings,
+            'source': {'width': source_size[0], 'height': source_size[1]}}
@@ -0,0 +1,89 @@
+"""
+ONNX Runtime vs PyTorch parity for the depth service.
+
+Runs against real MiDaS_small weights: a local clone in MIDAS_REPO_PATH (with
+MIDAS_WEIGHTS_PATH, or weights already in the torch hub cache), or a repo and
+checkpoint torch.hub has cached before. Skipped when torch, onnx, onnxruntime or
+the weights are unavailable; the test never downloads anything. MIDAS_ONNX_PATH
+is tested when set, otherwise the model is exported to a temporary file.
+"""
+
+import glob
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import depth_service  # noqa: E402
+
+MODEL = 'MiDaS_small'
+# The same tolerance the CLI parity check and the README document
+TOLERANCE = 1e-3
+
+
+def _hub_weights(hub_dir):
+    return glob.glob(os.path.join(hub_dir, 'checkpoints', 'midas_v21_small*.pt'))
+
+
+@pytest.fixture(scope='module')
+def midas():
+    """Point the depth service at local MiDaS_small weights, or skip"""
+    torch = pytest.importorskip('torch')
+    pytest.importorskip('onnx')
+    pytest.importorskip('onnxruntime')
+    pytest.importorskip('cv2')
+
+    hub_dir = torch.hub.get_dir()
+    repo_path = depth_service.MIDAS_REPO_PATH or os.path.join(hub_dir, 'intel-isl_MiDaS_master')
+    if not os.path.isdir(repo_path):
+        pytest.skip('MiDaS repo unavailable: set MIDAS_REPO_PATH to a local clone of intel-isl/MiDaS')
+    if not (depth_service.MIDAS_WEIGHTS_PATH or _hub_weights(hub_dir)):
+        pytest.skip('MiDaS_small weights unavailable: set MIDAS_WEIGHTS_PATH')
+
+    patch = pytest.MonkeyPatch()
+    # A local repo keeps torch.hub off the network; the cached checkpoint supplies pretrained weights
+    patch.setattr(depth_service, 'MIDAS_REPO_PATH', repo_path)
+    try:
+        depth_service.get_depth_model(MODEL, backend='torch')
+    except Exception as e:
+        patch.undo()
+        pytest.skip(f"MiDaS_small could not be loaded: {e}")
+    yield
+    patch.undo()
+
+
+@pytest.fixture(scope='module')
+def onnx_path(midas, tmp_path_factory):
+    if depth_service.MIDAS_ONNX_PATH:
+        return depth_service.MIDAS_ONNX_PATH
+    return depth_service.export_onnx(str(tmp_path_factory.mktemp('onnx') / 'midas_small.onnx'), MODEL)
+
+
+def painting(height, width, seed=0):
+    """Smooth gradients under soft-edged shapes with a little texture, close enough to a painting for MiDaS"""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width] / max(height, width)
+    image = np.stack([0.3 + 0.5 * y, 0.2 + 0.6 * x, 0.6 - 0.3 * x * y], axis=-1)
+    for _ in range(6):
+        cy, cx, radius = rng.random(3) * (1, 1, 0.25) + (0, 0, 0.05)
+        blob = np.clip(1.5 - np.hypot(y - cy * height / max(height, width), x - cx) / radius, 0, 1)[..., None]
+        image = image * (1 - blob) + rng.random(3) * blob
+    image += rng.normal(0, 0.02, image.shape)
+    return (np.clip(image, 0, 1) * 255).astype(np.uint8)
+
+
+@pytest.mark.parametrize('height, width', [(256, 256), (480, 640), (900, 600)])
+def test_onnx_matches_torch(onnx_path, height, width):
+    result = depth_service.check_parity(painting(height, width), MODEL, onnx_path, tolerance=TOLERANCE)
+    assert result['ok'], result
+
+
+def test_batched_tiles_match_torch(onnx_path):
+    # Tiled depth runs the exported graph on its dynamic batch axis
+    img_np = painting(700, 900, seed=1)
+    reference = depth_service.get_depth_model(MODEL, backend='torch').estimate_tiled(img_np)
+    candidate = depth_service.get_depth_model(MODEL, backend='onnx', onnx_path=onnx_path).estimate_tiled(img_np)
+    assert np.abs(reference.astype(np.float64) - candidate).max() <= TOLERANCE